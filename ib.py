@@ -12,7 +12,7 @@
 # limitations under the License.
 
 
-import argparse, ast, os, platform, subprocess, tempfile, textwrap
+import argparse, ast, BaseHTTPServer, contextlib, cPickle, ctypes, ctypes.util, distutils.spawn, errno, fnmatch, hashlib, itertools, json, marshal, multiprocessing.pool, os, platform, Queue, re, shutil, signal, socket, SocketServer, struct, subprocess, sys, tempfile, textwrap, threading, time, traceback, urllib2
 
 
 class IbError(Exception): pass
@@ -23,11 +23,43 @@ def GetExt(path):
   return ext
 
 
+def EscapeNinjaPath(path):
+  return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def GetStamp(path):
+  "A string that changes whenever the file at the given path is touched, or '-' if there is no such file."
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return '-'
+  return '%r,%d' % (stat.st_mtime, stat.st_size)
+
+
+def ParseDeps(text):
+  "The prerequisites of the make rule written by the compiler's -M flags."
+  return text.split(':', 1)[1].replace('\\', ' ').split()
+
+
 def ReplaceExt(path, new_ext):
   head, _ = os.path.splitext(path)
   return head + new_ext
 
 
+def WriteIfChanged(path, text):
+  "Writes the text to the file at the given path, unless it already holds it, so that its stamp stays put."
+  try:
+    with open(path) as f:
+      if f.read() == text:
+        return
+  except IOError:
+    pass
+  if not os.path.exists(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write(text)
+
+
 def YieldSubtypes(base_type):
   for obj in globals().itervalues():
     if type(obj) is type and issubclass(obj, base_type) and obj is not base_type:
@@ -42,14 +74,36 @@ class Rule(object):
     super(Rule, self).__init__()
     self.outputs = outputs
     self.dependencies = set()
+    # Dependencies that must be made first, but whose contents don't matter
+    # to the outputs.
+    self.order_only_dependencies = set()
     self.recipe_lines = []
     self.show_progress = 0
     self.recipe_action = 'Building'
+    self.depfile = None
+    self.cacheable = False
     for output in outputs:
       dirname = os.path.dirname(output)
       if dirname and not os.path.exists(dirname):
         os.makedirs(dirname)
 
+  @property
+  def ninja_rule_name(self):
+    return self.recipe_action.lower() + ('_with_depfile' if self.depfile else '')
+
+  @property
+  def ninja_script(self):
+    return 'build %s: %s%s%s\n  cmd = %s\n%s' % (
+        ' '.join(EscapeNinjaPath(output) for output in self.outputs),
+        self.ninja_rule_name,
+        ''.join(' $\n    %s' % EscapeNinjaPath(dependency)
+                for dependency in sorted(self.dependencies - self.order_only_dependencies)),
+        ''.join(' $\n    %s' % EscapeNinjaPath(dependency)
+                for dependency in [ '||' ] + sorted(self.order_only_dependencies)
+                if self.order_only_dependencies),
+        ' && '.join(line.replace('$', '$$') for line in self.recipe_lines),
+        '  depfile = %s\n' % EscapeNinjaPath(self.depfile) if self.depfile else '')
+
   @property
   def script(self):
     progress_recipe = ''
@@ -59,9 +113,11 @@ class Rule(object):
       else:
         progress_recipe = '\t@$(SHOW_PROGRESS) %s done\n' % self.recipe_action
 
-    return '%s:%s\n%s\n' % (
+    return '%s:%s%s\n%s\n' % (
         ' '.join(self.outputs),
-        ''.join(' \\\n%s' % dependency for dependency in self.dependencies),
+        ''.join(' \\\n%s' % dependency for dependency in sorted(self.dependencies - self.order_only_dependencies)),
+        ''.join(' \\\n%s' % dependency for dependency in [ '|' ] + sorted(self.order_only_dependencies)
+                if self.order_only_dependencies),
         progress_recipe + '\n'.join('\t%s' % line for line in self.recipe_lines))
 
   def AppendToRecipe(self, args):
@@ -87,6 +143,9 @@ class Spec(object):
         self.branch == other.branch and
         self.ext == other.ext)
 
+  def __ne__(self, other):
+    return not self == other
+
   def __hash__(self):
     return hash((self.atom, self.branch, self.ext))
 
@@ -108,6 +167,15 @@ class Spec(object):
       yield ext
 
 
+class ArchiveSpec(Spec):
+  def __init__(self, *args, **kwargs):
+    super(ArchiveSpec, self).__init__(*args, **kwargs)
+
+  PREFIX = ''
+  DEFAULT_EXT = '.a'
+  OTHER_EXTS = []
+
+
 class CppSpec(Spec):
   def __init__(self, *args, **kwargs):
     super(CppSpec, self).__init__(*args, **kwargs)
@@ -160,6 +228,27 @@ class ObjSpec(Spec):
   OTHER_EXTS = []
 
 
+class PchSpec(Spec):
+  "A precompiled header, which compilers look for under its header's name plus an extension of their own."
+
+  def __init__(self, *args, **kwargs):
+    super(PchSpec, self).__init__(*args, **kwargs)
+
+  @property
+  def relpath(self):
+    return os.path.join(
+        self.branch,
+        type(self).PREFIX + self.atom + HdrSpec.DEFAULT_EXT + self.ext)
+
+  @classmethod
+  def ConvBaseToAtom(cls, base):
+    return os.path.splitext(base[len(cls.PREFIX):])[0]
+
+  PREFIX = ''
+  DEFAULT_EXT = '.gch'
+  OTHER_EXTS = [ '.pch' ]
+
+
 def GetDefaultRelatedSpec(old_spec, new_type):
   return new_type(old_spec.branch, old_spec.atom, new_type.DEFAULT_EXT)
 
@@ -216,11 +305,18 @@ class Job(object):
       raise IbError("%s: cannot replace %s output with %s" % (
           self.desc, key, output_spec.relpath))
 
+  def GetOutputAbspath(self, planner, key):
+    return planner.GetPlan(self.GetOutputSpec(key)).GetOutputAbspath(planner)
+
   def GetRule(self, planner):
     return Rule(
-      [ planner.GetPlan(self.GetOutputSpec(key)).GetOutputAbspath(planner)
+      [ self.GetOutputAbspath(planner, key)
         for key in type(self).OUTPUT_SPEC_TYPES ])
 
+  def YieldOtherInputSpecs(self, planner):
+    "Yields the specs besides the input spec that must be made before this job runs."
+    return []
+
 
 class CompilerJob(Job):
   def __init__(self, *args, **kwargs):
@@ -235,15 +331,60 @@ class CompilerJob(Job):
       plan = planner.GetPlan(hdr)
       if plan.doable:
         rule.dependencies.add(plan.GetOutputAbspath(planner))
+    if planner.emit_depfiles:
+      rule.depfile = self.GetDepfile(planner)
+    # A provisional header list may be missing headers, so its rule can't be
+    # trusted to name everything the output depends on.
+    rule.cacheable = input_abspath not in planner.provisional_hdrs
+    pch_args = []
+    for pch_spec in self.YieldOtherInputSpecs(planner):
+      rule.dependencies.add(planner.GetPlan(pch_spec).GetOutputAbspath(planner))
+      # The compiler finds the precompiled header next to the header itself.
+      pch_args = [ '-include', planner.GetPlan(GetDefaultRelatedSpec(
+          pch_spec, HdrSpec)).GetOutputAbspath(planner) ]
     rule.AppendToRecipe(
-        planner.GetCcArgs() + [ '-c', '-o ' + rule.outputs[0], input_abspath ])
+        planner.GetCcArgs() + pch_args +
+        ([ '-MMD', '-MF', rule.depfile ] if rule.depfile else []) +
+        [ '-c', '-o ' + rule.outputs[0], input_abspath ])
     return rule
 
+  def GetDepfile(self, planner):
+    return planner.GetPlan(self.GetOutputSpec('obj')).GetOutputAbspath(planner) + '.d'
+
+  def YieldOtherInputSpecs(self, planner):
+    pch_spec = planner.GetPchSpec()
+    if pch_spec is not None:
+      yield pch_spec
+
   VERB = 'compile'
   INPUT_SPEC_TYPE = CppSpec
   OUTPUT_SPEC_TYPES = { 'obj': ObjSpec }
 
 
+class PchJob(Job):
+  def __init__(self, *args, **kwargs):
+    super(PchJob, self).__init__(*args, **kwargs)
+
+  def GetRule(self, planner):
+    rule = super(PchJob, self).GetRule(planner)
+    rule.recipe_action = 'Precompiling'
+    input_abspath = planner.GetPlan(self.input_spec).GetOutputAbspath(planner)
+    rule.dependencies.add(input_abspath)
+    for hdr in planner.GetHdrs(input_abspath):
+      plan = planner.GetPlan(hdr)
+      if plan.doable:
+        rule.dependencies.add(plan.GetOutputAbspath(planner))
+    pch_flags = planner.cfg.cc.pch_flags if hasattr(planner.cfg.cc, 'pch_flags') else [ '-x', 'c++-header' ]
+    rule.AppendToRecipe(
+        planner.GetCcArgs() + pch_flags +
+        [ '-o ' + rule.outputs[0], input_abspath ])
+    return rule
+
+  VERB = 'precompile'
+  INPUT_SPEC_TYPE = HdrSpec
+  OUTPUT_SPEC_TYPES = { 'pch': PchSpec }
+
+
 class LinkerJob(Job):
   def __init__(self, *args, **kwargs):
     super(LinkerJob, self).__init__(*args, **kwargs)
@@ -252,21 +393,76 @@ class LinkerJob(Job):
   def extra_link_opts(self):
     return []
 
-  def GetRule(self, planner):
+  @property
+  def links_archives(self):
+    "Whether the link may take objects from archives, which only supply the objects it has undefined symbols for."
+    return False
+
+  @property
+  def links_shared_libs(self):
+    "Whether the link may take objects from the shared libraries made for tests."
+    return False
+
+  def GetObjAbspaths(self, planner):
+    "Returns the objects of the input spec's plan and of every plan it implies or takes input from, transitively."
     plans = set()
     planner.GetPlan(self.input_spec).ExtendPlans(planner, plans)
+    objs = set()
+    for plan in plans:
+      if type(plan.output_spec) is ObjSpec:
+        abspath = plan.GetOutputAbspath(planner)
+        objs.add(planner.unity_objs.get(abspath, abspath))
+    return objs
+
+  def GetRule(self, planner):
     rule = super(LinkerJob, self).GetRule(planner)
     rule.recipe_action = 'Linking';
+    rule.cacheable = True
     out_flag_prefix = planner.cfg.link.out_flag_prefix if hasattr(planner.cfg.link, 'out_flag_prefix') else '-o '
     lib_flag_prefix = planner.cfg.link.lib_flag_prefix if hasattr(planner.cfg.link, 'lib_flag_prefix') else '-l'
-    for plan in plans:
-      if type(plan.output_spec) is ObjSpec:
-        rule.dependencies.add(plan.GetOutputAbspath(planner))
+    objs = set()
+    archives = set()
+    shared_libs = set()
+    for abspath in self.GetObjAbspaths(planner):
+      shared_lib = planner.shared_objs.get(abspath) if self.links_shared_libs else None
+      archive = planner.archived_objs.get(abspath) if self.links_archives else None
+      if shared_lib is not None:
+        shared_libs.add(shared_lib)
+      elif archive is not None:
+        archives.add(archive)
+      else:
+        objs.add(abspath)
+    shared_libs = planner.CloseSharedLibs(shared_libs)
+    rule.dependencies |= objs | archives | shared_libs
+    # The loader reads the shared libraries afresh on every run, so changing
+    # them needn't relink; but the output names them by absolute path, so it
+    # can't be shared through a cache.
+    rule.order_only_dependencies |= shared_libs
+    if shared_libs:
+      rule.cacheable = False
+    # GNU ld searches each archive once, in order, so archives that need one
+    # another are grouped to be searched until nothing new is found. The
+    # shared libraries don't record which of one another they need, so where
+    # ld defaults to --as-needed, it would drop one that only a later one
+    # needs; they're all kept instead, leaving ld's default for the libs
+    # that follow.
+    gnu = platform.system() != 'Darwin' and platform.system() != 'Windows'
+    group = gnu and len(archives) > 1
+    keep = gnu and bool(shared_libs)
+    inputs = planner.ConvArgsToRspArgs(
+        rule.outputs[0],
+        sorted(objs) +
+        ([ '-Wl,--start-group' ] if group else []) +
+        sorted(archives) +
+        ([ '-Wl,--end-group' ] if group else []) +
+        ([ '-Wl,--push-state,--no-as-needed' ] if keep else []) +
+        sorted(shared_libs) +
+        ([ '-Wl,--pop-state' ] if keep else []))
     rule.AppendToRecipe(
         [ planner.cfg.link.tool ] +
         self.extra_link_opts +
         planner.cfg.link.flags +
-        [ out_flag_prefix + rule.outputs[0] ] + list(rule.dependencies) +
+        [ out_flag_prefix + rule.outputs[0] ] + inputs +
         [ '-L' + lib_dir for lib_dir in planner.cfg.link.lib_dirs ] +
         [ lib_flag_prefix + lib for lib in planner.cfg.link.libs ] +
         ([ '-Wl,-Bstatic' ] if platform.system() != 'Darwin' and platform.system() != 'Windows' else []) +
@@ -288,8 +484,17 @@ class ExeJob(LinkerJob):
     # It should really backtrack from foo-main to foo-main.o properly.
     if rule.outputs[0].endswith("-main"):
       rule.AppendToRecipe([ "cp", "-afl", rule.outputs[0], rule.outputs[0][:-5] ])
+      rule.cacheable = False
     return rule
 
+  @property
+  def links_archives(self):
+    return True
+
+  @property
+  def links_shared_libs(self):
+    return self.input_spec.atom.endswith('-test')
+
   OUTPUT_SPEC_TYPES = { 'exe': ExeSpec }
 
 
@@ -304,6 +509,51 @@ class SoJob(LinkerJob):
   OUTPUT_SPEC_TYPES = { 'so': SoSpec }
 
 
+class SharedLibJob(SoJob):
+  "Links objects of one branch into a shared library for tests to link against instead of the objects. Planner.ShareTestJobs makes these, rather than a producer."
+
+  def __init__(self, input_spec, obj_abspaths):
+    super(SharedLibJob, self).__init__(input_spec)
+    self.obj_abspaths = obj_abspaths
+
+  def GetObjAbspaths(self, planner):
+    return set(self.obj_abspaths)
+
+  def GetOutputAbspath(self, planner, key):
+    return os.path.join(planner.out_root, self.GetOutputSpec(key).relpath)
+
+  INPUT_SPEC_TYPE = None
+
+
+class ArchiveJob(Job):
+  "Archives objects of one branch, so that links can name the archive instead of each object. Planner.ArchiveJobs makes these, rather than a producer."
+
+  def __init__(self, input_spec, obj_abspaths):
+    super(ArchiveJob, self).__init__(input_spec)
+    self.obj_abspaths = obj_abspaths
+
+  def GetOutputAbspath(self, planner, key):
+    return os.path.join(planner.out_root, self.GetOutputSpec(key).relpath)
+
+  def GetRule(self, planner):
+    rule = super(ArchiveJob, self).GetRule(planner)
+    rule.recipe_action = 'Archiving'
+    rule.cacheable = True
+    rule.dependencies |= set(self.obj_abspaths)
+    # The archiver adds to whatever archive is already there, so objects that
+    # have since left the branch would linger.
+    rule.AppendToRecipe([ 'rm', '-f', rule.outputs[0] ])
+    rule.AppendToRecipe(
+        [ planner.cfg.archive.tool ] + planner.cfg.archive.flags +
+        [ rule.outputs[0] ] +
+        planner.ConvArgsToRspArgs(rule.outputs[0], self.obj_abspaths))
+    return rule
+
+  VERB = 'archive'
+  INPUT_SPEC_TYPE = None
+  OUTPUT_SPEC_TYPES = { 'archive': ArchiveSpec }
+
+
 class Producer(object):
   def __init__(self, key, job_type):
     super(Producer, self).__init__()
@@ -325,7 +575,7 @@ def _InitJobTypes():
   global _PRODUCERS_BY_OUTPUT_SPEC_TYPE
   _PRODUCERS_BY_OUTPUT_SPEC_TYPE = {}
   for job_type in YieldSubtypes(Job):
-    if not hasattr(job_type, 'OUTPUT_SPEC_TYPES'):
+    if getattr(job_type, 'INPUT_SPEC_TYPE', None) is None or not hasattr(job_type, 'OUTPUT_SPEC_TYPES'):
       continue
     for key, spec_type in job_type.OUTPUT_SPEC_TYPES.iteritems():
       _PRODUCERS_BY_OUTPUT_SPEC_TYPE.setdefault(spec_type, []).append(Producer(key, job_type))
@@ -346,12 +596,7 @@ class Plan(object):
     return True
 
   def ExtendPlans(self, planner, plans):
-    if self not in plans:
-      plans.add(self)
-      for implied_spec in self.YieldImpliedSpecs(planner):
-        planner.GetPlan(implied_spec).ExtendPlans(planner, plans)
-      if self.input_spec is not None:
-        planner.GetPlan(self.input_spec).ExtendPlans(planner, plans)
+    plans |= planner.GetClosure(self)
 
   def YieldImpliedSpecs(self, planner):
     for implied_spec in self.output_spec.YieldImpliedSpecs(planner, self.GetOutputAbspath(planner)):
@@ -392,7 +637,34 @@ class JobPlan(DoablePlan):
     return os.path.join(planner.out_root, self.output_spec.relpath)
 
   def IsReady(self, planner):
-    return planner.IsMade(self.input_spec)
+    return planner.IsMade(self.input_spec) and all(
+        planner.IsMade(spec) for spec in self.job.YieldOtherInputSpecs(planner))
+
+
+class GenPlan(DoablePlan):
+  "A plan for a file that the planner itself writes into the output tree."
+
+  def __init__(self, output_spec):
+    super(GenPlan, self).__init__()
+    self.output_spec = output_spec
+
+  @property
+  def desc(self):
+    return 'generated'
+
+  @property
+  def input_spec(self):
+    return None
+
+  @property
+  def job(self):
+    return None
+
+  def GetOutputAbspath(self, planner):
+    return os.path.join(planner.out_root, self.output_spec.relpath)
+
+  def IsReady(self, planner):
+    return True
 
 
 class SrcPlan(DoablePlan):
@@ -459,16 +731,474 @@ class NoPlan(UndoablePlan):
 # -----------------------------------------------------------------------------
 
 
+class BuildState(object):
+  "The persistent state of an output tree, loaded once and saved atomically."
+
+  def __init__(self, path):
+    super(BuildState, self).__init__()
+    self.path = path
+    self.tables = {}
+    self.dirty = False
+    try:
+      with open(path, 'rb') as f:
+        version, tables = cPickle.load(f)
+      if version == BuildState.VERSION:
+        self.tables = tables
+    except Exception:
+      # A missing, truncated or foreign file costs us a cold cache, nothing more.
+      pass
+
+  def Get(self, table_name, key):
+    return self.tables.get(table_name, {}).get(key)
+
+  def GetTable(self, table_name):
+    return self.tables.get(table_name, {})
+
+  def Put(self, table_name, key, value):
+    self.tables.setdefault(table_name, {})[key] = value
+    self.dirty = True
+
+  def Save(self):
+    if not self.dirty:
+      return
+    dirname = os.path.dirname(self.path)
+    if not os.path.exists(dirname):
+      os.makedirs(dirname)
+    with tempfile.NamedTemporaryFile(dir=dirname, prefix='.ib_state', delete=False) as f:
+      cPickle.dump((BuildState.VERSION, self.tables), f, cPickle.HIGHEST_PROTOCOL)
+      name = f.name
+    if platform.system() == 'Windows' and os.path.exists(self.path):
+      os.unlink(self.path)
+    os.rename(name, self.path)
+    self.dirty = False
+
+  FILENAME = '.ib_state'
+  VERSION = 1
+
+
+class SharedScans(object):
+  "Header scans shared by the planners of several configs, so that each source is scanned once per distinct set of preprocessor args."
+
+  def __init__(self):
+    super(SharedScans, self).__init__()
+    self.lock = threading.Lock()
+    self.events = {}
+    self.results = {}
+
+  def Scan(self, key, Run):
+    "Returns what Run returns, or what it returned for whichever planner asked for the key first. Safe to call from a worker thread."
+    with self.lock:
+      event = self.events.get(key)
+      first = event is None
+      if first:
+        event = self.events[key] = threading.Event()
+    if first:
+      try:
+        self.results[key] = Run()
+      finally:
+        event.set()
+    else:
+      event.wait()
+    # If the first scan failed, each planner tries for itself and reports its
+    # own error.
+    if key not in self.results:
+      return Run()
+    return self.results[key]
+
+
+class LabeledStream(object):
+  "Stands in for sys.stdout or sys.stderr while several configs build at once, starting each line a config writes with the config's name."
+
+  def __init__(self, stream):
+    super(LabeledStream, self).__init__()
+    self.stream = stream
+    self.pending = threading.local()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+  def EndLine(self):
+    "Writes out whatever the calling thread left of a line."
+    if getattr(self.pending, 'text', ''):
+      self.write('\n')
+
+  def flush(self):
+    self.stream.flush()
+
+  def write(self, text):
+    label = getattr(LabeledStream.labels, 'label', None)
+    if label is None:
+      self.stream.write(text)
+      return
+    # Only whole lines are written, so that the configs' lines don't mix.
+    lines = (getattr(self.pending, 'text', '') + text).split('\n')
+    self.pending.text = lines.pop()
+    if lines:
+      with LabeledStream.lock:
+        self.stream.write(''.join('[%s] %s\n' % (label, line) for line in lines))
+
+  @staticmethod
+  def Call(args):
+    "Runs args as subprocess.call does, but through sys.stdout, so that a config's tools are labeled too."
+    if not isinstance(sys.stdout, LabeledStream):
+      return subprocess.call(args)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+      sys.stdout.write(line)
+    return proc.wait()
+
+  @staticmethod
+  def SetLabel(label):
+    "Labels what the calling thread writes from now on."
+    LabeledStream.labels.label = label
+
+  labels = threading.local()
+  lock = threading.Lock()
+
+
+class ObjCache(object):
+  "A local content-addressed cache of build outputs, trimmed by evicting the least recently used."
+
+  def __init__(self, root, max_size):
+    super(ObjCache, self).__init__()
+    self.root = root
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def Fetch(self, key, outputs):
+    "Copies the outputs cached under the key into place, returning True iff they were all there."
+    try:
+      for index, output in enumerate(outputs):
+        path = self.GetPath(key, index)
+        ObjCache.CopyFile(path, output)
+        os.utime(path, None)
+    except (IOError, OSError):
+      with self.lock:
+        self.misses += 1
+      return False
+    with self.lock:
+      self.hits += 1
+    return True
+
+  def GetPath(self, key, index):
+    return os.path.join(self.root, key[:2], '%s.%d' % (key[2:], index))
+
+  def SaveStats(self):
+    "Adds this run's hits and misses to the totals kept in the cache, returning the new totals."
+    path = os.path.join(self.root, ObjCache.STATS_FILENAME)
+    try:
+      with open(path, 'rb') as f:
+        hits, misses = cPickle.load(f)
+    except Exception:
+      hits, misses = 0, 0
+    hits += self.hits
+    misses += self.misses
+    if not os.path.exists(self.root):
+      os.makedirs(self.root)
+    with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as f:
+      cPickle.dump((hits, misses), f, cPickle.HIGHEST_PROTOCOL)
+      name = f.name
+    if platform.system() == 'Windows' and os.path.exists(path):
+      os.unlink(path)
+    os.rename(name, path)
+    return hits, misses
+
+  def Store(self, key, outputs):
+    for index, output in enumerate(outputs):
+      ObjCache.CopyFile(output, self.GetPath(key, index))
+
+  def Trim(self):
+    "Evicts the least recently used entries until the cache fits in max_size bytes, returning its size and file count."
+    entries = []
+    for dirpath, _, filenames in os.walk(self.root):
+      if dirpath == self.root:
+        continue
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    size = sum(entry_size for _, entry_size, _ in entries)
+    count = len(entries)
+    for _, entry_size, path in entries:
+      if self.max_size is None or size <= self.max_size:
+        break
+      try:
+        os.unlink(path)
+      except OSError:
+        continue
+      size -= entry_size
+      count -= 1
+    return size, count
+
+  @staticmethod
+  def CopyFile(src, dst):
+    # Copying to a temporary file in the same directory and renaming it into
+    # place keeps readers from ever seeing half a file.
+    dirname = os.path.dirname(dst)
+    if not os.path.exists(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        if not os.path.isdir(dirname):
+          raise
+    with open(src, 'rb') as f:
+      with tempfile.NamedTemporaryFile(dir=dirname, delete=False) as g:
+        shutil.copyfileobj(f, g)
+        name = g.name
+    shutil.copymode(src, name)
+    if platform.system() == 'Windows' and os.path.exists(dst):
+      os.unlink(dst)
+    os.rename(name, dst)
+
+  STATS_FILENAME = 'stats'
+
+
+class HttpCache(object):
+  "A client for a cache server (see --serve_cache), with the same Fetch and Store as ObjCache."
+
+  def __init__(self, url):
+    super(HttpCache, self).__init__()
+    self.url = url.rstrip('/')
+    self.hits = 0
+    self.misses = 0
+    self.broken = False
+    self.lock = threading.Lock()
+
+  def Fetch(self, key, outputs):
+    try:
+      responses = [ self.Request('GET', key, index) for index in range(len(outputs)) ]
+    except (urllib2.HTTPError, ValueError):
+      responses = None
+    except (urllib2.URLError, IOError):
+      responses = None
+      self.broken = True
+    if responses is None:
+      with self.lock:
+        self.misses += 1
+      return False
+    for (body, mode), output in zip(responses, outputs):
+      with tempfile.NamedTemporaryFile(dir=os.path.dirname(output), delete=False) as f:
+        f.write(body)
+        name = f.name
+      os.chmod(name, mode)
+      if platform.system() == 'Windows' and os.path.exists(output):
+        os.unlink(output)
+      os.rename(name, output)
+    with self.lock:
+      self.hits += 1
+    return True
+
+  def Request(self, method, key, index, body=None, mode=None):
+    "Returns the body and file mode of the response."
+    # An unreachable server would otherwise cost a timeout per job.
+    if self.broken:
+      raise urllib2.URLError('%s is unreachable' % self.url)
+    request = urllib2.Request('%s/%s.%d' % (self.url, key, index), data=body)
+    request.get_method = lambda: method
+    if mode is not None:
+      request.add_header(HttpCache.MODE_HEADER, '%o' % mode)
+    response = urllib2.urlopen(request, timeout=HttpCache.TIMEOUT)
+    return response.read(), HttpCache.ParseMode(
+        response.info().getheader(HttpCache.MODE_HEADER, '644'))
+
+  @staticmethod
+  def ParseMode(text):
+    "Parses an octal file mode sent by the other side, keeping only the permission bits, so it can't set setuid, setgid or sticky bits."
+    return int(text, 8) & 0777
+
+  def Store(self, key, outputs):
+    try:
+      for index, output in enumerate(outputs):
+        with open(output, 'rb') as f:
+          self.Request('PUT', key, index, f.read(), os.stat(output).st_mode & 0777)
+    except (urllib2.URLError, IOError):
+      self.broken = True
+
+  MODE_HEADER = 'X-Ib-Mode'
+  TIMEOUT = 10
+
+
+class CacheRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  "Serves an ObjCache directory: GET /<key>.<index> fetches an entry and PUT stores one."
+
+  def GetPath(self):
+    match = re.match(r'^/([0-9a-f]{40})\.([0-9]+)$', self.path)
+    if match is None:
+      return None
+    return self.server.cache.GetPath(match.group(1), int(match.group(2)))
+
+  def do_GET(self):
+    path = self.GetPath()
+    try:
+      with open(path, 'rb') as f:
+        body = f.read()
+      os.utime(path, None)
+    except (IOError, OSError, TypeError):
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header(HttpCache.MODE_HEADER, '%o' % (os.stat(path).st_mode & 0777))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_PUT(self):
+    path = self.GetPath()
+    if path is None:
+      self.send_error(400)
+      return
+    try:
+      length = int(self.headers.getheader('Content-Length', 0))
+      mode = HttpCache.ParseMode(self.headers.getheader(HttpCache.MODE_HEADER, '644'))
+    except ValueError:
+      self.send_error(400)
+      return
+    if length < 0:
+      self.send_error(400)
+      return
+    body = self.rfile.read(length)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+      f.write(body)
+      name = f.name
+    try:
+      os.chmod(name, mode)
+      ObjCache.CopyFile(name, path)
+    finally:
+      os.unlink(name)
+    self.send_response(201)
+    self.end_headers()
+    self.server.Stored()
+
+
+class CacheServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  "A reference cache server that keeps its entries in an ObjCache directory."
+
+  def __init__(self, address, cache):
+    BaseHTTPServer.HTTPServer.__init__(self, address, CacheRequestHandler)
+    self.cache = cache
+    self.store_count = 0
+    self.lock = threading.Lock()
+
+  def Stored(self):
+    with self.lock:
+      self.store_count += 1
+      if self.store_count % CacheServer.TRIM_INTERVAL == 0:
+        self.cache.Trim()
+
+  daemon_threads = True
+  TRIM_INTERVAL = 100
+
+
+# -----------------------------------------------------------------------------
+
+
 class Planner(object):
-  def __init__(self, cfg, src_root, out_root, cwd=os.getcwd()):
+  def __init__(self, cfg, src_root, out_root, cwd=os.getcwd(), jobs=None,
+               emit_depfiles=False, cache=None, remote_cache=None,
+               profiler=None, slots=None, shared_scans=None):
     self.cfg = cfg
     self.src_root = src_root
     self.out_root = out_root
+    self.jobs = jobs or multiprocessing.cpu_count()
+    self.emit_depfiles = emit_depfiles
+    self.cache = cache
+    self.remote_cache = remote_cache
+    self.profiler = profiler or Profiler()
+    # Planners building several configs at once share their slots, so that
+    # together they run no more than self.jobs recipes and scans at a time.
+    self.slots = slots or threading.BoundedSemaphore(self.jobs)
+    self.shared_scans = shared_scans
     self.branch = self.TryConvAbspathToRelpath(cwd)
     self.cached_jobs = {}
     self.cached_plans = {}
+    self.cached_closures = {}
     self.cached_hdrs = {}
+    self.cached_listings = {}
+    self.provisional_hdrs = {}
+    self.cached_stamps = {}
+    self.cached_tool_stamps = {}
+    self.generated_texts = {}
+    self.hdrs_digest = None
+    self.pch_spec = None
+    self.unity_objs = {}
+    self.archived_objs = {}
+    self.shared_objs = {}
+    self.shared_lib_needs = {}
     self.made_specs = set()
+    self.state = BuildState(os.path.join(out_root, BuildState.FILENAME))
+
+  def ArchiveJobs(self, jobs):
+    "Adds jobs archiving, branch by branch, the objects that the links of executables need besides their own, and has those links take them from the archives."
+    # A link's own object is always named directly, and a branch with one
+    # object left gains nothing from an archive.
+    self.archived_objs = {}
+    own_objs = set()
+    objs_by_branch = {}
+    for job in jobs:
+      if isinstance(job, LinkerJob) and type(job.input_spec) is ObjSpec:
+        abspath = self.GetPlan(job.input_spec).GetOutputAbspath(self)
+        own_objs.add(self.unity_objs.get(abspath, abspath))
+    for job in jobs:
+      if isinstance(job, LinkerJob) and job.links_archives:
+        for abspath in job.GetObjAbspaths(self):
+          if abspath not in own_objs and not (
+              job.links_shared_libs and abspath in self.shared_objs):
+            objs_by_branch.setdefault(
+                os.path.dirname(abspath)[len(self.out_root) + 1:], set()).add(abspath)
+    new_jobs = list(jobs)
+    for branch, objs in sorted(objs_by_branch.iteritems()):
+      if len(objs) < 2:
+        continue
+      spec = ArchiveSpec(branch, Planner.ARCHIVE_ATOM, ArchiveSpec.DEFAULT_EXT)
+      new_jobs.append(ArchiveJob(spec, sorted(objs)))
+      for abspath in objs:
+        self.archived_objs[abspath] = os.path.join(self.out_root, spec.relpath)
+    return new_jobs
+
+  def ChoosePchNames(self):
+    "Returns the headers included with angle brackets by at least half of the sources scanned so far, most often included first."
+    # Only headers outside the tree are considered, since in-tree ones change
+    # often, and only as sources name them, since a header a system header
+    # includes may not compile by itself.
+    srcs = [
+        abspath for abspath in self.state.GetTable('hdrs')
+        if abspath.startswith(self.src_root + os.sep) and
+            GetExt(abspath) in _SPEC_TYPE_BY_EXT and
+            GetSpecTypeByExt(GetExt(abspath)) is CppSpec ]
+    counts = {}
+    for abspath in srcs:
+      stamp = self.GetStamp(abspath)
+      entry = self.state.Get('angle_includes', abspath)
+      if entry is None or entry[0] != stamp:
+        try:
+          with open(abspath) as f:
+            names = sorted(set(Planner.ANGLE_INCLUDE_PATTERN.findall(f.read())))
+        except IOError:
+          names = []
+        entry = (stamp, names)
+        self.state.Put('angle_includes', abspath, entry)
+      for name in entry[1]:
+        counts[name] = counts.get(name, 0) + 1
+    return [ '<%s>' % name for name in sorted(
+        counts, key=lambda name: (-counts[name], name))
+        if counts[name] >= 2 and counts[name] * 2 >= len(srcs) ]
+
+  def CloseSharedLibs(self, shared_libs):
+    "Returns the given shared libraries and every one their members need, transitively."
+    closed = set(shared_libs)
+    pending = list(closed)
+    while pending:
+      for needed in self.shared_lib_needs.get(pending.pop(), []):
+        if needed not in closed:
+          closed.add(needed)
+          pending.append(needed)
+    return closed
 
   def ConvAbspathToRelpath(self, abspath):
     relpath = self.TryConvAbspathToRelpath(abspath)
@@ -481,6 +1211,22 @@ class Planner(object):
   def ConvAbspathToSpec(self, abspath):
     return self.ConvRelpathToSpec(self.ConvAbspathToRelpath(abspath))
 
+  def ConvArgsToRspArgs(self, output, args):
+    "Returns the args, or if they would make too long a command line, an argument naming a response file beside the output that holds them."
+    if sum(len(arg) + 1 for arg in args) <= Planner.RSP_THRESHOLD:
+      return args
+    rsp_abspath = output + '.rsp'
+    WriteIfChanged(rsp_abspath, '\n'.join(args) + '\n')
+    return [ '@' + rsp_abspath ]
+
+  def ConvDepsToHdrs(self, deps):
+    hdrs = []
+    for dep in deps:
+      spec = self.TryConvAbspathToSpec(dep)
+      if spec is not None:
+        hdrs.append(spec)
+    return hdrs[1:]
+
   def ConvRelpathToSpec(self, relpath):
     branch, name = os.path.split(relpath)
     base, ext = os.path.splitext(name)
@@ -502,8 +1248,8 @@ class Planner(object):
   def ConvTargetToSpec(self, target):
     return self.ConvRelpathToSpec(self.ConvTargetToRelpath(target))
 
-  def ConvWaveToScript(self, wave, show_progress):
-    rules = [ job.GetRule(self) for job in wave ]
+  def ConvRulesToScript(self, rules, show_progress):
+    rules = list(rules)
     all_rule = Rule([ self.cfg.make.all_pseudo_target ])
     for rule in rules:
       all_rule.dependencies |= set(rule.outputs)
@@ -524,46 +1270,173 @@ class Planner(object):
 
     return progress_preamble + '\n'.join(rule.script for rule in rules)
 
+  def ConvRulesToNinja(self, rules):
+    preamble = 'ninja_required_version = 1.3\nbuilddir = %s\n\n' % (
+        EscapeNinjaPath(self.out_root))
+    ninja_rules = {}
+    for rule in rules:
+      ninja_rules[rule.ninja_rule_name] = rule
+    for name, rule in sorted(ninja_rules.iteritems()):
+      preamble += 'rule %s\n  command = $cmd\n  description = %s $out\n' % (
+          name, rule.recipe_action)
+      if rule.depfile:
+        preamble += '  depfile = $depfile\n  deps = gcc\n'
+      preamble += '  restat = 1\n\n'
+    return preamble + '\n'.join(rule.ninja_script for rule in rules)
+
+  def ConvWaveToScript(self, wave, show_progress):
+    return self.ConvRulesToScript(
+        [ job.GetRule(self) for job in wave ], show_progress)
+
+  def Exists(self, abspath):
+    "Like os.path.exists, but answered from a memoized listing of the directory, so planning costs a listdir per directory rather than a stat per candidate spec."
+    dirname, basename = os.path.split(abspath)
+    return basename in self.ListDir(dirname)
+
+  def FindTests(self, relpath):
+    "Yields the spec of every test with a source in the given branch, skipping dot directories, the output tree and directories matching the cfg's test_all.ignore patterns."
+    ignore = self.cfg.test_all.ignore if hasattr(self.cfg, 'test_all') else []
+    pruned_dirs = [ self.out_root, os.path.dirname(self.out_root) ]
+    relpath = os.path.normpath(relpath)
+    pending_branches = [ relpath if relpath != '.' else '' ]
+    while pending_branches:
+      branch = pending_branches.pop()
+      for name in sorted(self.ListDir(os.path.join(self.src_root, branch))):
+        child = os.path.join(branch, name)
+        base, ext = os.path.splitext(name)
+        # Only names without a known extension can be directories worth a
+        # stat to find out.
+        if ext and ext in _SPEC_TYPE_BY_EXT:
+          if base.endswith('-test') and GetSpecTypeByExt(ext) is CppSpec:
+            yield ExeSpec(
+                branch, ExeSpec.ConvBaseToAtom(base), ExeSpec.DEFAULT_EXT)
+        elif (not name.startswith('.') and
+              not any(fnmatch.fnmatch(child, pattern) for pattern in ignore) and
+              os.path.join(self.src_root, child) not in pruned_dirs and
+              os.path.isdir(os.path.join(self.src_root, child))):
+          pending_branches.append(child)
+
+  def GetCacheKey(self, rule):
+    "Like the rule's signature, but blind to where the trees are and aware of which tools it runs."
+    def Portable(text):
+      return text.replace(self.out_root, '$OUT').replace(self.src_root, '$SRC')
+    key = hashlib.sha1(Portable('\n'.join(rule.recipe_lines)))
+    for line in rule.recipe_lines:
+      key.update('\0%s' % self.GetToolStamp(line.split(' ', 1)[0]))
+    for dependency in sorted(rule.dependencies):
+      key.update('\0%s\0%s' % (Portable(dependency), self.GetDigest(dependency)))
+    return key.hexdigest()
+
   def GetCcArgs(self):
     return [ self.cfg.cc.tool, '-I' + self.src_root, '-I' + self.out_root ]  \
         + [ '-I' + incl_dir for incl_dir in self.cfg.cc.incl_dirs ]  \
         + [ '-DIB_SRC_ROOT=' + self.src_root,
             '-DIB_OUT_ROOT=' + self.out_root ]  \
-        + self.cfg.cc.flags
+        + self.cfg.cc.flags  \
+        + self.GetSharedTestsCcFlags()
+
+  def GetClosure(self, plan):
+    "Returns the plan and every plan it implies or takes input from, transitively. Memoized for every plan visited along the way."
+    # This is Tarjan's algorithm, run without recursion so that deep include
+    # chains can't hit the recursion limit. Plans that imply one another (as
+    # with headers whose implementations include each other) form a component
+    # that shares one closure, and each component is closed only after
+    # everything it reaches, so its closure is a union of finished ones.
+    def YieldSuccessors(plan):
+      for implied_spec in plan.YieldImpliedSpecs(self):
+        yield self.GetPlan(implied_spec)
+      if plan.input_spec is not None:
+        yield self.GetPlan(plan.input_spec)
+    closure = self.cached_closures.get(plan)
+    if closure is not None:
+      return closure
+    indices = { plan: 0 }
+    lowlinks = { plan: 0 }
+    edges = { plan: [] }
+    stack = [ plan ]
+    stacked = set(stack)
+    work = [ (plan, YieldSuccessors(plan)) ]
+    while work:
+      node, successors = work[-1]
+      for successor in successors:
+        edges[node].append(successor)
+        if successor in self.cached_closures:
+          continue
+        if successor not in indices:
+          indices[successor] = lowlinks[successor] = len(indices)
+          edges[successor] = []
+          stack.append(successor)
+          stacked.add(successor)
+          work.append((successor, YieldSuccessors(successor)))
+          break
+        if successor in stacked:
+          lowlinks[node] = min(lowlinks[node], indices[successor])
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+        if lowlinks[node] == indices[node]:
+          members = []
+          while not members or members[-1] is not node:
+            members.append(stack.pop())
+            stacked.discard(members[-1])
+          closure = set(members)
+          for member in members:
+            for successor in edges[member]:
+              if successor not in closure:
+                closure |= self.cached_closures[successor]
+          closure = frozenset(closure)
+          for member in members:
+            self.cached_closures[member] = closure
+    return self.cached_closures[plan]
+
+  def GetDigest(self, path):
+    "A hash of the contents of the file at the given path, recomputed only when the file is touched."
+    # Files in the output tree can change mid-build, so only sources get the
+    # memoized stamp.
+    stamp = GetStamp(path) if path.startswith(self.out_root) else self.GetStamp(path)
+    entry = self.state.Get('digests', path)
+    if entry is not None and entry[0] == stamp:
+      return entry[1]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), ''):
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    self.state.Put('digests', path, (stamp, digest))
+    return digest
+
+  def GetFingerprint(self, spec):
+    "A hash of a built spec's contents and of the contents of every source and header in its closure."
+    plan = self.GetPlan(spec)
+    abspaths = set([ plan.GetOutputAbspath(self) ])
+    for closure_plan in self.GetClosure(plan):
+      if isinstance(closure_plan, SrcPlan):
+        abspath = closure_plan.GetOutputAbspath(self)
+        abspaths.add(abspath)
+        if isinstance(closure_plan.output_spec, CppSpec):
+          for hdr in self.GetHdrs(abspath):
+            abspaths.add(self.GetPlan(hdr).GetOutputAbspath(self))
+    fingerprint = hashlib.sha1()
+    for abspath in sorted(abspaths):
+      fingerprint.update('%s\0%s\0' % (abspath, self.GetDigest(abspath)))
+    return fingerprint.hexdigest()
 
   def GetHdrs(self, abspath):
     hdrs = self.cached_hdrs.get(abspath)
     if hdrs is None:
-      spec = self.ConvAbspathToSpec(abspath)
-      spec.ext += ".ib_hdrs"
-      cache_path = os.path.join(self.out_root, spec.relpath)
-      try:
-        with open(cache_path) as f:
-          for line in f:
-            hdrs.append(self.ConvRelpathToSpec(line))
-        self.cached_hdrs[abspath] = hdrs
-      except:
-        hdrs = None
+      hdrs = self.TryLoadHdrs(abspath)
     if hdrs is None:
-      args = self.GetCcArgs() + self.cfg.cc.hdrs_flags + [ abspath ]
-      output = subprocess.check_output(args)
-      output = output.split(':', 1)[1]
-      output = output.replace('\\', ' ')
-      hdrs = []
-      for line in output.split():
-        spec = self.TryConvAbspathToSpec(line.strip())
-        if spec is not None:
-          hdrs.append(spec)
-      hdrs = hdrs[1:]
-      self.cached_hdrs[abspath] = hdrs
-      cache_dir = os.path.dirname(cache_path)
-      if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-      with open(cache_path, 'w') as f:
-        for hdr in hdrs:
-          f.write('%s\n' % hdr.relpath)
+      hdrs = self.StoreHdrs(abspath, self.ScanHdrs(abspath))
     return hdrs
 
+  def GetHdrsDigest(self):
+    if self.hdrs_digest is None:
+      args = self.GetCcArgs() + self.cfg.cc.hdrs_flags
+      self.hdrs_digest = hashlib.sha1('\0'.join(args)).hexdigest()
+    return self.hdrs_digest
+
   def GetJob(self, job_type, input_spec):
     key = (job_type, input_spec)
     job = self.cached_jobs.get(key)
@@ -572,11 +1445,35 @@ class Planner(object):
       self.cached_jobs[key] = job
     return job
 
+  def GetNinjaArgs(self):
+    return (
+        [ self.cfg.ninja.tool if hasattr(self.cfg, 'ninja') else 'ninja' ] +
+        (self.cfg.ninja.flags if hasattr(self.cfg, 'ninja') else []) +
+        [ '-f', os.path.join(self.out_root, Planner.NINJA_FILENAME) ])
+
+  def GetPchSpec(self):
+    "Returns the spec of the precompiled header that every compile includes first, or None if the cfg doesn't ask for one."
+    if self.pch_spec is None:
+      pch = self.cfg.cc.pch if hasattr(self.cfg.cc, 'pch') else []
+      names = self.ChoosePchNames() if pch == 'auto' else pch
+      if not names:
+        self.pch_spec = False
+      else:
+        hdr_spec = HdrSpec('', Planner.PCH_ATOM, HdrSpec.DEFAULT_EXT)
+        self.WriteGenerated(hdr_spec, ''.join(
+            '#include %s\n' % (name if name[0] in '<"' else '<%s>' % name)
+            for name in names))
+        pch_ext = self.cfg.cc.pch_ext if hasattr(self.cfg.cc, 'pch_ext') else PchSpec.DEFAULT_EXT
+        self.pch_spec = PchSpec('', Planner.PCH_ATOM, pch_ext)
+    return self.pch_spec or None
+
   def GetPlan(self, output_spec):
     plan = self.cached_plans.get(output_spec)
     if plan is None:
       plans = []
-      if os.path.exists(os.path.join(self.src_root, output_spec.relpath)):
+      if output_spec in self.generated_texts:
+        plans.append(GenPlan(output_spec))
+      elif self.Exists(os.path.join(self.src_root, output_spec.relpath)):
         plans.append(SrcPlan(output_spec))
       for producer in GetProducersByOutputSpecType(type(output_spec)):
         for job in producer.YieldJobs(self, output_spec):
@@ -591,21 +1488,308 @@ class Planner(object):
       self.cached_plans[output_spec] = plan
     return plan
 
+  def GetSharedTestsCcFlags(self):
+    "Returns the flags every compile needs for its object to go in a shared library, if tests link against them."
+    if not hasattr(self.cfg, 'shared_tests'):
+      return []
+    return self.cfg.shared_tests.cc_flags if hasattr(self.cfg.shared_tests, 'cc_flags') else [ '-fPIC' ]
+
+  def GetScanDigest(self):
+    "A hash of the compiler args that can change what a source includes, blind to where the output tree is."
+    # Only debug info and warning flags are left out. Optimization, sanitizer
+    # and PIC flags define macros (__OPTIMIZE__, __SANITIZE_ADDRESS__,
+    # __PIC__) that can change what gets included, and -Wp, passes flags
+    # straight to the preprocessor.
+    return hashlib.sha1('\0'.join(
+        arg.replace(self.out_root, '$OUT')
+        for arg in self.GetCcArgs() + self.cfg.cc.hdrs_flags
+        if not Planner.SCAN_NEUTRAL_FLAG_PATTERN.match(arg))).hexdigest()
+
+  def GetSignature(self, rule):
+    "A hash of a rule's exact commands and the contents of its dependencies."
+    signature = hashlib.sha1('\n'.join(rule.recipe_lines))
+    for dependency in sorted(rule.dependencies):
+      if dependency in rule.order_only_dependencies:
+        signature.update('\0%s' % dependency)
+      else:
+        signature.update('\0%s\0%s' % (dependency, self.GetDigest(dependency)))
+    return signature.hexdigest()
+
+  def GetStamp(self, path):
+    stamp = self.cached_stamps.get(path)
+    if stamp is None:
+      stamp = GetStamp(path)
+      self.cached_stamps[path] = stamp
+    return stamp
+
+  def CheckSignatures(self, rules):
+    "Readies outputs for an mtime-based tool by comparing their recorded signatures with the current ones."
+    # A changed signature means the command (e.g., the cfg) or an input's
+    # contents changed, so the outputs are removed to force a rebuild. A
+    # matching one means inputs were only touched, so the outputs are touched
+    # to spare them.
+    for rule in rules:
+      signature = self.state.Get('sigs', rule.outputs[0])
+      if signature is None or not all(os.path.exists(output) for output in rule.outputs):
+        continue
+      if not all(os.path.exists(dependency) for dependency in rule.dependencies):
+        continue
+      if signature == self.GetSignature(rule):
+        oldest = min(os.stat(output).st_mtime for output in rule.outputs)
+        if any(os.stat(dependency).st_mtime > oldest
+               for dependency in rule.dependencies - rule.order_only_dependencies):
+          for output in rule.outputs:
+            os.utime(output, None)
+      else:
+        for output in rule.outputs:
+          os.unlink(output)
+
+  def GetToolStamp(self, tool):
+    stamp = self.cached_tool_stamps.get(tool)
+    if stamp is None:
+      path = distutils.spawn.find_executable(tool)
+      stamp = '%s %s' % (path, GetStamp(path)) if path else tool
+      self.cached_tool_stamps[tool] = stamp
+    return stamp
+
+  def IngestDepfiles(self, jobs, since):
+    "Updates the header cache from compiles done since the given time, returning True iff a provisional header list was wrong."
+    if not self.emit_depfiles:
+      return False
+    ninja_deps = None
+    replan = False
+    for job in jobs:
+      if not isinstance(job, CompilerJob):
+        continue
+      obj_abspath = self.GetPlan(job.GetOutputSpec('obj')).GetOutputAbspath(self)
+      try:
+        obj_mtime = os.stat(obj_abspath).st_mtime
+      except OSError:
+        continue
+      if obj_mtime < int(since):
+        continue
+      depfile = job.GetDepfile(self)
+      if os.path.exists(depfile):
+        with open(depfile) as f:
+          deps = ParseDeps(f.read())
+      else:
+        if ninja_deps is None:
+          ninja_deps = self.ReadNinjaDeps()
+        deps = ninja_deps.get(obj_abspath)
+        if deps is None:
+          continue
+      # Anything touched after the compile finished makes the depfile
+      # untrustworthy, so leave that source to be scanned next time.
+      for dep in deps:
+        self.cached_stamps[dep] = GetStamp(dep)
+      try:
+        if any(os.stat(dep).st_mtime > obj_mtime for dep in deps):
+          continue
+      except OSError:
+        continue
+      abspath = self.GetPlan(job.input_spec).GetOutputAbspath(self)
+      hdrs = self.StoreHdrs(abspath, deps)
+      provisional_hdrs = self.provisional_hdrs.pop(abspath, None)
+      if provisional_hdrs is not None and set(provisional_hdrs) != set(hdrs):
+        # The output was built from the source as it is now, so only its
+        # recorded signature, taken over the old header list, is out of date.
+        self.RecordSignatures([ job.GetRule(self) ])
+        replan = True
+    return replan
+
   def IsMade(self, spec):
     return spec in self.made_specs
 
-  def RunScript(self, script, force=False):
+  def ListDir(self, dirname):
+    "Returns the names in a directory, memoized, or none if it isn't one."
+    listing = self.cached_listings.get(dirname)
+    if listing is None:
+      try:
+        listing = frozenset(os.listdir(dirname))
+      except OSError:
+        listing = frozenset()
+      self.cached_listings[dirname] = listing
+    return listing
+
+  def PrefetchHdrs(self, output_specs):
+    "Scans the headers of every source reachable from the given specs, self.jobs at a time."
+    # A source's implied specs are only followed once its scan comes back, so
+    # afterward GetHdrs, GetPlan and YieldWaves just read the memo.
+    def Scan(abspath):
+      try:
+        return abspath, self.ScanHdrs(abspath), None
+      except Exception, err:
+        return abspath, None, err
+    pool = multiprocessing.pool.ThreadPool(self.jobs)
+    results = Queue.Queue()
+    waiting_specs = {}
+    old_specs = set(output_specs)
+    pending_specs = list(old_specs)
+    try:
+      while pending_specs or waiting_specs:
+        if not pending_specs:
+          abspath, deps, err = results.get()
+          if err is not None:
+            raise err
+          self.StoreHdrs(abspath, deps)
+          pending_specs = waiting_specs.pop(abspath)
+        spec = pending_specs.pop()
+        plan = self.GetPlan(spec)
+        if not plan.doable:
+          continue
+        if isinstance(spec, CppSpec):
+          abspath = plan.GetOutputAbspath(self)
+          if abspath not in self.cached_hdrs and self.TryLoadHdrs(abspath) is None:
+            if abspath not in waiting_specs:
+              waiting_specs[abspath] = []
+              pool.apply_async(Scan, (abspath,), callback=results.put)
+            waiting_specs[abspath].append(spec)
+            continue
+        new_specs = list(plan.YieldImpliedSpecs(self))
+        if plan.input_spec is not None:
+          new_specs.append(plan.input_spec)
+        for new_spec in new_specs:
+          if new_spec not in old_specs:
+            old_specs.add(new_spec)
+            pending_specs.append(new_spec)
+    finally:
+      pool.close()
+      pool.join()
+
+  def RecordSignatures(self, rules):
+    "Records the signatures of the rules whose outputs are now up to date by mtime."
+    for rule in rules:
+      try:
+        oldest = min(os.stat(output).st_mtime for output in rule.outputs)
+        if any(os.stat(dependency).st_mtime > oldest
+               for dependency in rule.dependencies - rule.order_only_dependencies):
+          continue
+      except OSError:
+        continue
+      self.state.Put('sigs', rule.outputs[0], self.GetSignature(rule))
+
+  def ReadNinjaDeps(self):
+    "Returns the dependencies that ninja's deps log holds for each output."
+    if not os.path.exists(os.path.join(self.out_root, Planner.NINJA_FILENAME)):
+      return {}
+    deps = {}
+    output_deps = None
+    for line in subprocess.check_output(self.GetNinjaArgs() + [ '-t', 'deps' ]).splitlines():
+      if not line.strip():
+        output_deps = None
+      elif line[0].isspace():
+        if output_deps is not None:
+          output_deps.append(line.strip())
+      else:
+        output, info = line.split(': #deps', 1)
+        output_deps = [] if '(VALID)' in info else None
+        if output_deps is not None:
+          deps[output] = output_deps
+    return deps
+
+  def RunNinja(self, text, force=False, keep_going=False):
+    path = os.path.join(self.out_root, Planner.NINJA_FILENAME)
+    with open(path, 'w') as f:
+      f.write(text)
+    args = self.GetNinjaArgs()
+    if force and LabeledStream.Call(args + [ '-t', 'clean' ]) != 0:
+      return False
+    return LabeledStream.Call(
+        args + [ '-j%d' % self.jobs ] + ([ '-k', '0' ] if keep_going else [])) == 0
+
+  def RunRules(self, rules, force=False, keep_going=False, show_progress=False):
+    return Executor(
+        self, rules, force=force, keep_going=keep_going,
+        show_progress=show_progress).Run()
+
+  def RunScript(self, script, force=False, jobs=None, keep_going=False):
     with tempfile.NamedTemporaryFile(delete=False) as f:
       f.write(script)
       name = f.name
     try:
-      return subprocess.call(
+      return LabeledStream.Call(
           [ self.cfg.make.tool ] + self.cfg.make.flags +
           ([ self.cfg.make.force_flag] if force else []) +
+          ([ '-j%d' % jobs ] if jobs else []) +
+          ([ '-k' ] if keep_going else []) +
           [ '-f' + name, self.cfg.make.all_pseudo_target ]) == 0
     finally:
       os.unlink(name)
 
+  def SaveState(self):
+    self.state.Save()
+
+  def ScanHdrs(self, abspath):
+    "Runs the compiler to find the dependencies of a source. Safe to call from a worker thread."
+    args = self.GetCcArgs() + self.cfg.cc.hdrs_flags + [ abspath ]
+    def Scan():
+      with self.profiler.Span('scan %s' % abspath, 'scan'), self.slots:
+        return ParseDeps(subprocess.check_output(args))
+    if self.shared_scans is None:
+      return Scan()
+    # Shared deps name whichever output tree scanned them as $OUT.
+    out_prefix = self.out_root + os.sep
+    deps = self.shared_scans.Scan(
+        (self.GetScanDigest(), abspath),
+        lambda: [
+            '$OUT' + os.sep + dep[len(out_prefix):] if dep.startswith(out_prefix) else dep
+            for dep in Scan() ])
+    return [
+        out_prefix + dep[len('$OUT' + os.sep):] if dep.startswith('$OUT' + os.sep) else dep
+        for dep in deps ]
+
+  def ShareTestJobs(self, jobs):
+    "Adds jobs linking, branch by branch, the objects that tests need besides their own into shared libraries, and has the tests' links take them from those."
+    # Each test's own object stays out, so what's shared is the code under
+    # test, which changes without changing what the tests link against.
+    self.shared_objs = {}
+    self.shared_lib_needs = {}
+    def GetObjAbspath(plan):
+      abspath = plan.GetOutputAbspath(self)
+      return self.unity_objs.get(abspath, abspath)
+    own_objs = set()
+    objs_by_branch = {}
+    reached_objs = {}
+    for job in jobs:
+      if isinstance(job, LinkerJob) and type(job.input_spec) is ObjSpec:
+        own_objs.add(GetObjAbspath(self.GetPlan(job.input_spec)))
+    for job in jobs:
+      if isinstance(job, LinkerJob) and job.links_shared_libs:
+        for plan in self.GetClosure(self.GetPlan(job.input_spec)):
+          if type(plan.output_spec) is not ObjSpec:
+            continue
+          abspath = GetObjAbspath(plan)
+          if abspath not in own_objs:
+            objs_by_branch.setdefault(
+                os.path.dirname(abspath)[len(self.out_root) + 1:], set()).add(abspath)
+            reached_objs.setdefault(abspath, set()).update(
+                GetObjAbspath(reached_plan) for reached_plan in self.GetClosure(plan)
+                if type(reached_plan.output_spec) is ObjSpec)
+    new_jobs = list(jobs)
+    for branch, objs in sorted(objs_by_branch.iteritems()):
+      spec = SoSpec(branch, Planner.SHARED_LIB_ATOM, SoSpec.DEFAULT_EXT)
+      new_jobs.append(SharedLibJob(spec, sorted(objs)))
+      for abspath in objs:
+        self.shared_objs[abspath] = os.path.join(self.out_root, spec.relpath)
+    # A shared library is left with undefined references to the objects its
+    # members need from other branches, which the tests must then link.
+    for abspath, reached in reached_objs.iteritems():
+      shared_lib = self.shared_objs[abspath]
+      self.shared_lib_needs.setdefault(shared_lib, set()).update(
+          self.shared_objs[reached_abspath] for reached_abspath in reached
+          if reached_abspath in self.shared_objs and
+              self.shared_objs[reached_abspath] != shared_lib)
+    return new_jobs
+
+  def StoreHdrs(self, abspath, deps):
+    hdrs = self.ConvDepsToHdrs(deps)
+    self.cached_hdrs[abspath] = hdrs
+    self.cached_closures = {}
+    self.state.Put(
+        'hdrs', abspath,
+        (self.GetHdrsDigest(), [ (dep, self.GetStamp(dep)) for dep in deps ]))
+    return hdrs
+
   def TryConvAbspathToRelpath(self, abspath):
     for root in [ self.src_root, self.out_root ]:
       if abspath.startswith(root):
@@ -616,6 +1800,91 @@ class Planner(object):
     relpath = self.TryConvAbspathToRelpath(abspath)
     return self.ConvRelpathToSpec(relpath) if relpath is not None else None
 
+  def TryLoadHdrs(self, abspath):
+    # The entry is stale if the compiler args changed or if the source or any
+    # file it included was touched since the scan or compile that wrote it.
+    entry = self.state.Get('hdrs', abspath)
+    if entry is None:
+      return None
+    digest, stamped_deps = entry
+    if digest != self.GetHdrsDigest():
+      return None
+    # When compiles write depfiles, a source that was compiled before can
+    # skip its scan; the compile's depfile will confirm or correct its old
+    # header list afterward.
+    provisional = False
+    for dep, stamp in stamped_deps:
+      if self.GetStamp(dep) != stamp:
+        if not self.emit_depfiles:
+          return None
+        provisional = True
+    hdrs = self.ConvDepsToHdrs([ dep for dep, _ in stamped_deps ])
+    self.cached_hdrs[abspath] = hdrs
+    if provisional:
+      self.provisional_hdrs[abspath] = hdrs
+    return hdrs
+
+  def UnifyJobs(self, jobs):
+    "Replaces the compiles of sources that the same links need with compiles of generated sources that include them, unity.size at a time."
+    # Sources are only batched with others needed by exactly the same links,
+    # so no link gets an object it didn't ask for.
+    unsafe = self.cfg.unity.unsafe if hasattr(self.cfg.unity, 'unsafe') else []
+    self.unity_objs = {}
+    links_by_obj = {}
+    for job in jobs:
+      if isinstance(job, LinkerJob):
+        for plan in self.GetClosure(self.GetPlan(job.input_spec)):
+          if type(plan.output_spec) is ObjSpec:
+            links_by_obj.setdefault(plan.output_spec, set()).add(job)
+    groups = {}
+    new_jobs = []
+    for job in jobs:
+      if (isinstance(job, CompilerJob) and
+          job.GetOutputSpec('obj') in links_by_obj and
+          isinstance(self.GetPlan(job.input_spec), SrcPlan) and
+          not any(fnmatch.fnmatch(job.input_spec.relpath, pattern)
+                  for pattern in unsafe)):
+        groups.setdefault(
+            frozenset(links_by_obj[job.GetOutputSpec('obj')]), []).append(job)
+      else:
+        new_jobs.append(job)
+    unity_obj_specs = []
+    for group in groups.itervalues():
+      group.sort(key=lambda job: job.input_spec.relpath)
+      for index in range(0, len(group), self.cfg.unity.size):
+        members = group[index:index + self.cfg.unity.size]
+        if len(members) == 1:
+          new_jobs.extend(members)
+          continue
+        srcs = [
+            self.GetPlan(job.input_spec).GetOutputAbspath(self)
+            for job in members ]
+        src_spec = CppSpec(
+            Planner.UNITY_BRANCH, hashlib.sha1('\0'.join(srcs)).hexdigest()[:16],
+            CppSpec.DEFAULT_EXT)
+        self.WriteGenerated(
+            src_spec, ''.join('#include "%s"\n' % src for src in srcs))
+        obj_spec = GetDefaultRelatedSpec(src_spec, ObjSpec)
+        unity_obj_specs.append(obj_spec)
+        for job in members:
+          self.unity_objs[self.GetPlan(
+              job.GetOutputSpec('obj')).GetOutputAbspath(self)] = (
+                  os.path.join(self.out_root, obj_spec.relpath))
+    self.PrefetchHdrs(unity_obj_specs)
+    return new_jobs + [ self.GetPlan(spec).job for spec in unity_obj_specs ]
+
+  def WriteGenerated(self, spec, text):
+    "Makes the spec's plan a GenPlan and writes its file, unless it already holds the text, so that its stamp stays put."
+    self.generated_texts[spec] = text
+    self.cached_plans.pop(spec, None)
+    WriteIfChanged(os.path.join(self.out_root, spec.relpath), text)
+
+  def YieldGraph(self, output_specs):
+    "Yields all the jobs as a single wave, leaving the rules' own dependencies to order them."
+    jobs = [ job for wave in self.YieldWaves(output_specs) for job in wave ]
+    if jobs:
+      yield jobs
+
   def YieldWaves(self, output_specs):
     for spec in output_specs:
       plan = self.GetPlan(spec)
@@ -633,6 +1902,10 @@ class Planner(object):
           input_spec = plan.input_spec
           if input_spec is not None and input_spec not in old_specs:
             new_specs.add(input_spec)
+          if plan.job is not None:
+            for other_input_spec in plan.job.YieldOtherInputSpecs(self):
+              if other_input_spec not in old_specs:
+                new_specs.add(other_input_spec)
           if plan.IsReady(self):
             ready_specs.add(spec)
             for implied_spec in plan.YieldImpliedSpecs(self):
@@ -658,6 +1931,407 @@ class Planner(object):
       self.made_specs |= ready_specs
       pending_specs = unready_specs
 
+  ANGLE_INCLUDE_PATTERN = re.compile(r'^\s*#\s*include\s*<([^>]+)>', re.MULTILINE)
+  ARCHIVE_ATOM = 'ib_archive'
+  NINJA_FILENAME = 'build.ninja'
+  PCH_ATOM = 'ib_pch'
+  RSP_THRESHOLD = 1 << 15
+  SCAN_NEUTRAL_FLAG_PATTERN = re.compile(r'^-(g|w$|W(?!p,))')
+  SHARED_LIB_ATOM = 'ib_shared'
+  UNITY_BRANCH = 'ib_unity'
+
+
+# -----------------------------------------------------------------------------
+
+
+class Executor(object):
+  "Runs the recipes of rules directly, in dependency order, on a pool of worker threads."
+
+  def __init__(self, planner, rules, force=False, keep_going=False, show_progress=False):
+    super(Executor, self).__init__()
+    self.planner = planner
+    self.rules = rules
+    self.force = force
+    self.keep_going = keep_going
+    self.show_progress = show_progress
+    self.statuses = {}
+    self.outputs = {}
+    self.signatures = {}
+    self.cache_keys = {}
+    self.caches = [
+        cache for cache in [ planner.cache, planner.remote_cache ]
+        if cache is not None ]
+    self.stopped = False
+
+  @property
+  def failed_rules(self):
+    return [ rule for rule in self.rules if self.statuses.get(rule, 0) != 0 ]
+
+  def FetchFromCaches(self, key, outputs):
+    "Fetches the outputs from the nearest cache that has them, copying them into the nearer ones."
+    for index, cache in enumerate(self.caches):
+      if cache.Fetch(key, outputs):
+        for nearer_cache in self.caches[:index]:
+          nearer_cache.Store(key, outputs)
+        return True
+    return False
+
+  def IsStale(self, rule, rebuilt_inputs):
+    for dependency in rule.dependencies:
+      if not os.path.exists(dependency):
+        raise IbError(
+            "%s depends on %s; however, it doesn't exist and no rule makes "
+            "it." % (rule.outputs[0], dependency))
+    self.signatures[rule] = self.planner.GetSignature(rule)
+    if self.force:
+      return True
+    try:
+      oldest = min(os.stat(output).st_mtime for output in rule.outputs)
+    except OSError:
+      return True
+    # Outputs built before signatures were recorded fall back on mtimes.
+    signature = self.planner.state.Get('sigs', rule.outputs[0])
+    if signature is not None:
+      return signature != self.signatures[rule]
+    return bool(rebuilt_inputs) or any(
+        os.stat(dependency).st_mtime > oldest
+        for dependency in rule.dependencies - rule.order_only_dependencies)
+
+  def Run(self):
+    "Returns True iff every rule is up to date afterward."
+    producers = {}
+    for rule in self.rules:
+      for output in rule.outputs:
+        producers[output] = rule
+    inputs = {}
+    blockers = {}
+    dependents = dict((rule, []) for rule in self.rules)
+    for rule in self.rules:
+      inputs[rule] = set(
+          producers[dependency] for dependency in rule.dependencies
+          if dependency in producers)
+      blockers[rule] = set(inputs[rule])
+      for input_rule in inputs[rule]:
+        dependents[input_rule].append(rule)
+    ready_rules = [ rule for rule in self.rules if not blockers[rule] ]
+    rebuilt_rules = set()
+    done_count = 0
+    running_count = 0
+    pool = multiprocessing.pool.ThreadPool(self.planner.jobs)
+    results = Queue.Queue()
+    try:
+      while (ready_rules and not self.stopped) or running_count:
+        if ready_rules and not self.stopped:
+          rule = ready_rules.pop()
+          if self.IsStale(rule, inputs[rule] & rebuilt_rules):
+            if self.caches and rule.cacheable:
+              self.cache_keys[rule] = self.planner.GetCacheKey(rule)
+            pool.apply_async(self.RunRecipe, (rule,), callback=results.put)
+            running_count += 1
+            continue
+          rule_ran, status = False, 0
+        else:
+          rule, status, output = results.get()
+          rule_ran = True
+          running_count -= 1
+          if status is None:
+            # Cancelled once the run stopped, so it neither failed nor finished.
+            for path in rule.outputs:
+              if os.path.exists(path):
+                os.unlink(path)
+            continue
+          self.statuses[rule] = status
+          self.outputs[rule] = output
+          if status != 0:
+            print '%s*** %s failed with status %d ***%s' % (
+                RED, rule.outputs[0], status, NORMAL)
+          sys.stdout.write(output)
+        done_count += 1
+        if status == 0:
+          self.planner.state.Put('sigs', rule.outputs[0], self.signatures[rule])
+          if rule_ran:
+            rebuilt_rules.add(rule)
+          if rule_ran and self.show_progress:
+            print '[%3d%%] %s %s' % (
+                done_count * 100 / len(self.rules), rule.recipe_action,
+                rule.outputs[0])
+          for dependent in dependents[rule]:
+            blockers[dependent].discard(rule)
+            if not blockers[dependent]:
+              ready_rules.append(dependent)
+        else:
+          for output in rule.outputs:
+            if os.path.exists(output):
+              os.unlink(output)
+          self.stopped = not self.keep_going
+    finally:
+      self.stopped = True
+      pool.close()
+      pool.join()
+    if done_count < len(self.rules) and not self.failed_rules:
+      raise IbError(
+          "no progress on %s" % ', '.join(
+              rule.outputs[0] for rule in self.rules if blockers[rule]))
+    return done_count == len(self.rules) and not self.failed_rules
+
+  def RunRecipe(self, rule):
+    "Runs the lines of a rule's recipe, stopping at the first failure. The status is None if the run stopped first. Called on a worker thread."
+    output = []
+    key = self.cache_keys.get(rule)
+    start = time.time()
+    cached = False
+    try:
+      if key is not None and self.FetchFromCaches(key, rule.outputs):
+        cached = True
+        # The old depfile doesn't describe the restored output.
+        if rule.depfile and os.path.exists(rule.depfile):
+          os.unlink(rule.depfile)
+        return rule, 0, ''
+      for line in rule.recipe_lines:
+        if self.stopped:
+          return rule, None, ''
+        with self.planner.slots:
+          proc = subprocess.Popen(
+              line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+          output.append(proc.communicate()[0])
+        if proc.returncode != 0:
+          output.append('%s\n' % line)
+          return rule, proc.returncode, ''.join(output)
+      if key is not None:
+        for cache in self.caches:
+          cache.Store(key, rule.outputs)
+      # Kept so later runs can tell what rebuilding this output costs.
+      self.planner.state.Put(
+          'recipe_times', rule.outputs[0], time.time() - start)
+    except Exception, err:
+      output.append('%s\n' % err)
+      return rule, -1, ''.join(output)
+    finally:
+      self.planner.profiler.AddRecipe(rule, start, time.time(), cached=cached)
+    return rule, 0, ''.join(output)
+
+
+class TestRunner(object):
+  "Runs test executables on a pool of worker threads, longest first by the durations recorded for them."
+
+  def __init__(self, planner, specs, jobs=None, timeout=None,
+               skip_unchanged=False):
+    super(TestRunner, self).__init__()
+    self.planner = planner
+    self.specs = specs
+    self.jobs = jobs or planner.jobs
+    self.timeout = timeout
+    self.skip_unchanged = skip_unchanged
+
+  def Run(self):
+    "Prints each test's result as it finishes, with the output of any that didn't pass, and then a summary. Returns True iff every test passed."
+    def GetOrder(spec):
+      # Tests not timed before go first, as they may be the longest.
+      elapsed = self.planner.state.Get('test_times', spec.relpath)
+      return -(elapsed if elapsed is not None else float('inf')), spec.relpath
+    # A test that passed against the same fingerprint as now can only pass
+    # again, unless it depends on something outside the build.
+    fingerprints = {}
+    skipped_count = 0
+    specs = []
+    for spec in sorted(set(self.specs), key=GetOrder):
+      fingerprints[spec] = self.planner.GetFingerprint(spec)
+      if (self.skip_unchanged and fingerprints[spec] ==
+          self.planner.state.Get('test_passes', spec.relpath)):
+        skipped_count += 1
+      else:
+        specs.append(spec)
+    results = dict((result, []) for result in TestRunner.RESULTS)
+    times = {}
+    start = time.time()
+    pool = multiprocessing.pool.ThreadPool(self.jobs)
+    try:
+      for done_count, (spec, result, elapsed, output) in enumerate(
+          pool.imap_unordered(self.RunTest, specs), start=1):
+        results[result].append(spec)
+        times[spec] = elapsed
+        if result != 'timed out':
+          self.planner.state.Put('test_times', spec.relpath, elapsed)
+        self.planner.state.Put(
+            'test_passes', spec.relpath,
+            fingerprints[spec] if result == 'passed' else None)
+        print '[%d/%d] %s %s (%.2fs)' % (
+            done_count, len(specs), TestRunner.Color(result),
+            spec.relpath, elapsed)
+        if result != 'passed':
+          sys.stdout.write(output)
+        sys.stdout.flush()
+    finally:
+      pool.close()
+      pool.join()
+    for result in TestRunner.RESULTS:
+      if results[result]:
+        print '%s %d (%s)' % (
+            TestRunner.Color(result), len(results[result]),
+            ', '.join(spec.relpath for spec in sorted(
+                results[result], key=lambda spec: spec.relpath)))
+    if skipped_count:
+      print '%s %d (unchanged since they last passed)' % (
+          TestRunner.Color('skipped'), skipped_count)
+    slowest = sorted(times, key=lambda spec: -times[spec])[:TestRunner.SLOWEST_COUNT]
+    print 'ran %d tests in %.2fs%s' % (
+        len(specs), time.time() - start,
+        '; slowest: ' + ', '.join(
+            '%s (%.2fs)' % (spec.relpath, times[spec]) for spec in slowest)
+        if slowest else '')
+    return not results['failed'] and not results['timed out']
+
+  def RunTest(self, spec):
+    "Runs one test, killing it if it outlasts the timeout. Called on a worker thread."
+    start = time.time()
+    try:
+      proc = subprocess.Popen(
+          [ os.path.join(self.planner.out_root, spec.relpath) ],
+          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError, err:
+      return spec, 'failed', 0.0, '%s\n' % err
+    killed = []
+    def Kill():
+      killed.append(True)
+      try:
+        proc.kill()
+      except OSError:
+        pass
+    timer = threading.Timer(self.timeout, Kill) if self.timeout else None
+    if timer is not None:
+      timer.start()
+    try:
+      output = proc.communicate()[0]
+    finally:
+      if timer is not None:
+        timer.cancel()
+    elapsed = time.time() - start
+    if killed:
+      return spec, 'timed out', elapsed, output
+    return spec, 'passed' if proc.returncode == 0 else 'failed', elapsed, output
+
+  @staticmethod
+  def Color(result):
+    return (GREEN if result in [ 'passed', 'skipped' ] else RED) + result + NORMAL
+
+  RESULTS = [ 'passed', 'failed', 'timed out' ]
+
+  SLOWEST_COUNT = 5
+
+
+# -----------------------------------------------------------------------------
+
+
+class Profiler(object):
+  "Records when each phase of a run starts and ends, for a Chrome trace and a summary of where the time went."
+
+  def __init__(self):
+    super(Profiler, self).__init__()
+    self.start = time.time()
+    self.events = []
+    self.recipes = []
+    self.thread_numbers = {}
+    self.lock = threading.Lock()
+
+  def Add(self, name, category, start, end, **details):
+    "Records a span of time on the current thread. Safe to call from any thread."
+    with self.lock:
+      thread_number = self.thread_numbers.setdefault(
+          threading.current_thread().ident, len(self.thread_numbers))
+      self.events.append({
+        'name': name, 'cat': category, 'ph': 'X', 'pid': 0,
+        'tid': thread_number, 'ts': int((start - self.start) * 1e6),
+        'dur': int((end - start) * 1e6), 'args': details })
+
+  def AddRecipe(self, rule, start, end, cached=False):
+    self.Add(
+        '%s %s' % (rule.recipe_action, rule.outputs[0]), 'recipe', start, end,
+        cached=cached)
+    with self.lock:
+      self.recipes.append((end, start, rule))
+
+  def GetCriticalPath(self):
+    "Returns the chain of recipes, each an input of the next, that took longest from the start of the first to the end of the last."
+    # A recipe can't end before its inputs do, so recipes in order of ending
+    # come after their inputs.
+    finishes = {}
+    paths = {}
+    for end, start, rule in sorted(self.recipes):
+      path = []
+      finish = 0.0
+      for dependency in rule.dependencies:
+        if finishes.get(dependency, 0.0) > finish:
+          finish = finishes[dependency]
+          path = paths[dependency]
+      path = path + [ (end - start, rule) ]
+      for output in rule.outputs:
+        finishes[output] = finish + end - start
+        paths[output] = path
+    return max(paths.itervalues(), key=lambda path: sum(
+        elapsed for elapsed, _ in path)) if paths else []
+
+  @contextlib.contextmanager
+  def Span(self, name, category, **details):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.Add(name, category, start, time.time(), **details)
+
+  def Summarize(self):
+    "Returns lines summarizing the time spent in each category, the critical path and the slowest compiles."
+    totals = {}
+    counts = {}
+    for event in self.events:
+      totals[event['cat']] = totals.get(event['cat'], 0) + event['dur'] / 1e6
+      counts[event['cat']] = counts.get(event['cat'], 0) + 1
+    lines = [ 'profile: %.2fs in all; %s' % (
+        time.time() - self.start, ', '.join(
+            '%s %.2fs (%d)' % (category, totals[category], counts[category])
+            for category in sorted(totals))) ]
+    critical_path = self.GetCriticalPath()
+    if critical_path:
+      lines.append('critical path (%.2fs):' % sum(
+          elapsed for elapsed, _ in critical_path))
+      for elapsed, rule in critical_path:
+        lines.append('  %7.2fs  %s %s' % (
+            elapsed, rule.recipe_action, rule.outputs[0]))
+    compiles = sorted(
+        ((end - start, rule) for end, start, rule in self.recipes
+         if rule.recipe_action == 'Compiling'),
+        key=lambda item: -item[0])[:Profiler.SLOWEST_COUNT]
+    if compiles:
+      lines.append('slowest translation units:')
+      for elapsed, rule in compiles:
+        lines.append('  %7.2fs  %s' % (elapsed, rule.outputs[0]))
+    return lines
+
+  def TimeYields(self, name, category, iterable):
+    "Yields what the iterable does, recording how long each item took to produce."
+    iterator = iter(iterable)
+    for number in itertools.count(1):
+      start = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      finally:
+        self.Add('%s %d' % (name, number), category, start, time.time())
+      yield item
+
+  def Write(self, path):
+    "Writes the spans as a Chrome trace, which chrome://tracing and Perfetto can load."
+    with self.lock:
+      events = list(self.events) + [
+        { 'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': thread_number,
+          'args': { 'name': 'main' if thread_number == 0 else
+                            'worker %d' % thread_number } }
+        for thread_number in self.thread_numbers.itervalues() ]
+    with open(path, 'w') as f:
+      json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+
+  SLOWEST_COUNT = 10
+
 
 # -----------------------------------------------------------------------------
 
@@ -665,17 +2339,27 @@ class Planner(object):
 class Cfg(object):
   "A configuration object."
 
-  def __init__(self, root, name, base=None):
+  def __init__(self, root, name, base=None, cache_path=None):
     super(Cfg, self).__init__()
     self.Obj = Obj
     self.os = os
     self.platform = platform
     if base is not None:
       self.__dict__.update(base.__dict__)
-    imports = self.__Update(root, name, conv_dots=base is None)
+    old_codes = Cfg.LoadCodes(cache_path) if cache_path else {}
+    new_codes = {}
+    imports = self.__Update(root, name, old_codes, new_codes, conv_dots=base is None)
+    if cache_path and set(new_codes) != set(old_codes):
+      Cfg.SaveCodes(cache_path, new_codes)
     del self.__dict__['__builtins__']
     del self.Obj
-    self.cfg = Obj(name=name, base=base.cfg if base else None, imports=imports)
+    # The cfg files' contents decide everything else, so their hashes are
+    # enough to tell whether the cfg changed.
+    fingerprint = hashlib.sha1('\0'.join(
+        sorted(new_codes) + ([ base.cfg.fingerprint ] if base else []))).hexdigest()
+    self.cfg = Obj(
+        name=name, base=base.cfg if base else None, imports=imports,
+        fingerprint=fingerprint)
     for obj_name, field_names in Cfg.DEFAULT_EMPTY_LISTS.iteritems():
       obj = getattr(self, obj_name)
       for field_name in field_names:
@@ -694,11 +2378,35 @@ class Cfg(object):
         yield Comment(self.cfg, label)
         label = 'based on'
         cfg = cfg.base
+      yield '# fingerprint: %s' % self.cfg.fingerprint
       for key, val in self.__dict__.iteritems():
         if val is not self.cfg:
           yield '%s = %r' % (key, val)
     return '\n'.join(Lines())
 
+  @staticmethod
+  def LoadCodes(path):
+    "Returns the imports and code objects of the cfg files compiled by earlier runs, by a hash of each file's name and contents."
+    try:
+      with open(path, 'rb') as f:
+        version, codes = marshal.load(f)
+    except Exception:
+      return {}
+    # Marshalled code only loads into the Python that wrote it.
+    return codes if version == sys.version else {}
+
+  @staticmethod
+  def SaveCodes(path, codes):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+      os.makedirs(dirname)
+    with tempfile.NamedTemporaryFile(dir=dirname, prefix=Cfg.CACHE_FILENAME, delete=False) as f:
+      f.write(marshal.dumps((sys.version, codes)))
+      name = f.name
+    if platform.system() == 'Windows' and os.path.exists(path):
+      os.unlink(path)
+    os.rename(name, path)
+
   def Uses(self, some_name):
     def Check(cfg):
       return cfg.name == some_name or CheckImports(cfg.imports) or (Check(cfg.base) if cfg.base is not None else False)
@@ -706,7 +2414,7 @@ class Cfg(object):
       return any(name == some_name or CheckImports(nested_imports) for name, nested_imports in imports.iteritems())
     return Check(self.cfg)
 
-  def __Update(self, root, name, conv_dots=True):
+  def __Update(self, root, name, old_codes, new_codes, conv_dots=True):
     filename = os.path.join(root, *(name.split('.') if conv_dots else [ name ])) + '.cfg'
     if not os.path.isfile(filename):
       raise IbError(
@@ -714,15 +2422,24 @@ class Cfg(object):
           "however, the file %r does not exist." % (name, root, filename))
     with open(filename) as f:
       text = f.read()
-    scout = Scout()
-    for stmt in ast.parse(text, filename=filename).body:
-      scout.visit(stmt)
+    key = hashlib.sha1('%s\0%s' % (filename, text)).hexdigest()
+    entry = old_codes.get(key)
+    if entry is None:
+      scout = Scout()
+      for stmt in ast.parse(text, filename=filename).body:
+        scout.visit(stmt)
+      entry = (
+          scout.imports,
+          compile(ast.Module(body=scout.stmts), filename, mode='exec'))
+    new_codes[key] = entry
+    import_names, code = entry
     imports = {}
-    for name in scout.imports:
-      imports[name] = self.__Update(root, name)
-    exec compile(ast.Module(body=scout.stmts), filename, mode='exec') in self.__dict__
+    for name in import_names:
+      imports[name] = self.__Update(root, name, old_codes, new_codes)
+    exec code in self.__dict__
     return imports
 
+  CACHE_FILENAME = '.ib_cfg'
   DEFAULT_EMPTY_LISTS = {
     'cc':   [ 'incl_dirs' ],
     'link': [ 'libs', 'static_libs', 'lib_dirs' ]
@@ -763,6 +2480,628 @@ class Scout(ast.NodeVisitor):
 # -----------------------------------------------------------------------------
 
 
+class Watcher(object):
+  "Watches directory trees with inotify, collecting the paths that change in them."
+
+  def __init__(self, roots, pruned_dirs):
+    super(Watcher, self).__init__()
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(self.libc, 'inotify_init'):
+      raise OSError(errno.ENOSYS, 'inotify is not available here')
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    self.pruned_dirs = set(pruned_dirs)
+    self.dirs = {}
+    self.changes = {}
+    self.overflowed = False
+    self.lock = threading.Lock()
+    for root in roots:
+      self.AddTree(root)
+    thread = threading.Thread(target=self.Read)
+    thread.daemon = True
+    thread.start()
+
+  def AddTree(self, root):
+    for dirpath, dirnames, _ in os.walk(root):
+      dirnames[:] = [
+          dirname for dirname in dirnames
+          if not dirname.startswith('.') and
+              os.path.join(dirpath, dirname) not in self.pruned_dirs ]
+      wd = self.libc.inotify_add_watch(self.fd, dirpath, Watcher.MASK)
+      if wd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+      self.dirs[wd] = dirpath
+
+  def Read(self):
+    "Collects events until the process exits. Runs on its own thread."
+    while True:
+      events = os.read(self.fd, 1 << 16)
+      offset = 0
+      while offset < len(events):
+        wd, mask, _, length = struct.unpack_from('iIII', events, offset)
+        offset += struct.calcsize('iIII')
+        name = events[offset:offset + length].rstrip('\0')
+        offset += length
+        dirpath = self.dirs.get(wd)
+        if mask & Watcher.IN_IGNORED:
+          self.dirs.pop(wd, None)
+        if dirpath is None and not mask & Watcher.IN_Q_OVERFLOW:
+          continue
+        with self.lock:
+          if mask & Watcher.IN_Q_OVERFLOW:
+            self.overflowed = True
+            continue
+          path = os.path.join(dirpath, name) if name else dirpath
+          self.changes[path] = (
+              self.changes.get(path, False) or
+              bool(mask & Watcher.LISTING_MASK))
+        if mask & Watcher.IN_ISDIR and mask & Watcher.NEW_MASK:
+          try:
+            self.AddTree(path)
+          except OSError:
+            with self.lock:
+              self.overflowed = True
+
+  def TakeChanges(self):
+    "Returns the paths changed since the last call, each mapped to True iff it was created, deleted or moved; or None if changes were lost."
+    with self.lock:
+      changes, self.changes = self.changes, {}
+      overflowed, self.overflowed = self.overflowed, False
+    return None if overflowed else changes
+
+  IN_MODIFY = 0x2
+  IN_ATTRIB = 0x4
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_IGNORED = 0x8000
+  IN_ISDIR = 0x40000000
+  NEW_MASK = IN_MOVED_TO | IN_CREATE
+  LISTING_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+  MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | LISTING_MASK
+
+
+class Daemon(object):
+  "Keeps a planner in memory between builds, building for thin ib clients that connect over a unix socket."
+
+  def __init__(self, args):
+    super(Daemon, self).__init__()
+    self.args = args
+    self.planner = MakePlanner(args)
+    self.roots = [ args.src_root ]
+    if not args.cfg_root.startswith(args.src_root + os.sep):
+      self.roots.append(args.cfg_root)
+    self.pruned_dirs = [ args.out_root, os.path.dirname(args.out_root) ]
+    try:
+      self.watcher = Watcher(self.roots, self.pruned_dirs)
+    except OSError, err:
+      print 'not watching for changes (%s); every build will start afresh' % (
+          err.strerror)
+      self.watcher = None
+
+  def Handle(self, conn):
+    "Runs one client's build with the client's cwd and environment, streaming its output back, followed by a NUL and the exit status."
+    try:
+      cwd, environ, args = cPickle.load(conn.makefile('rb'))
+    except (EOFError, cPickle.UnpicklingError):
+      return
+    old_cwd = os.getcwd()
+    old_environ = dict(os.environ)
+    old_fds = [ os.dup(1), os.dup(2) ]
+    Daemon.Flush()
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+    try:
+      os.chdir(cwd)
+      os.environ.clear()
+      os.environ.update(environ)
+      status = self.Run(args)
+    except Exception, err:
+      status = -1
+      # The client may have hung up, which is likely why the build failed.
+      try:
+        if isinstance(err, (IbError, subprocess.CalledProcessError)):
+          ReportError(err)
+        else:
+          traceback.print_exc()
+      except IOError:
+        pass
+    finally:
+      Daemon.Flush()
+      for fd, old_fd in enumerate(old_fds, start=1):
+        os.dup2(old_fd, fd)
+        os.close(old_fd)
+      os.chdir(old_cwd)
+      os.environ.clear()
+      os.environ.update(old_environ)
+    try:
+      conn.sendall('\0%d' % status)
+    except socket.error:
+      pass
+
+  def IsWatched(self, path):
+    return (
+        any(path.startswith(root + os.sep) for root in self.roots) and
+        not any(path.startswith(pruned_dir + os.sep)
+                for pruned_dir in self.pruned_dirs))
+
+  def Refresh(self):
+    "Forgets what the planner knows about files that changed since the last build."
+    changes = self.watcher.TakeChanges() if self.watcher is not None else None
+    cfg_changed = changes is not None and any(
+        path.endswith('.cfg') and path.startswith(self.args.cfg_root + os.sep)
+        for path in changes)
+    if cfg_changed:
+      # A cfg file can be saved without changing what it says.
+      cfg_changed = (
+          LoadCfg(self.args).cfg.fingerprint != self.planner.cfg.cfg.fingerprint)
+    if changes is None or cfg_changed:
+      self.planner.SaveState()
+      self.planner = MakePlanner(self.args)
+      return
+    planner = self.planner
+    planner.cached_tool_stamps = {}
+    for path in planner.cached_stamps.keys():
+      if path in changes or not self.IsWatched(path):
+        del planner.cached_stamps[path]
+    # Creating or deleting a file can change the plan of any spec that might
+    # have been made from it, so plans go, along with the listings of the
+    # directories involved; they're cheap to remake once the header lists are
+    # known. A header list goes only if its source or one of its headers
+    # changed.
+    if any(changes.itervalues()):
+      planner.cached_plans = {}
+      for path, listed in changes.iteritems():
+        if listed:
+          planner.cached_listings.pop(os.path.dirname(path), None)
+          planner.cached_listings.pop(path, None)
+    if changes or planner.provisional_hdrs:
+      planner.cached_closures = {}
+    for abspath in planner.provisional_hdrs:
+      planner.cached_hdrs.pop(abspath, None)
+    planner.provisional_hdrs = {}
+    if changes:
+      for abspath in planner.cached_hdrs.keys():
+        entry = planner.state.Get('hdrs', abspath)
+        if abspath in changes or entry is None or any(
+            dep in changes for dep, _ in entry[1]):
+          del planner.cached_hdrs[abspath]
+
+  def Run(self, args):
+    for key in [ 'src_root', 'cfg_root', 'out_root' ]:
+      if getattr(args, key) != getattr(self.args, key):
+        raise IbError(
+            "This daemon builds with %s %r, not %r; restart it to change "
+            "roots." % (key, getattr(self.args, key), getattr(args, key)))
+    self.Refresh()
+    planner = self.planner
+    planner.profiler = Profiler()
+    planner.branch = planner.TryConvAbspathToRelpath(os.getcwd())
+    planner.jobs = args.jobs or multiprocessing.cpu_count()
+    planner.emit_depfiles = args.depfiles or args.backend == 'ninja'
+    planner.cache, planner.remote_cache = GetCaches(args)
+    return RunTargets(planner, args)
+
+  def Serve(self):
+    path = Daemon.GetSocketPath(self.args.out_root)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      server.connect(path)
+    except socket.error:
+      if os.path.exists(path):
+        os.unlink(path)
+    else:
+      raise IbError(
+          "A daemon is already serving %r on %r." % (self.args.out_root, path))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    print 'serving %s on %s' % (self.args.out_root, path)
+    sys.stdout.flush()
+    def Stop(signum, frame):
+      raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, Stop)
+    try:
+      while True:
+        conn, _ = server.accept()
+        try:
+          self.Handle(conn)
+        except Exception:
+          # One client's troubles mustn't take the daemon down for the rest.
+          traceback.print_exc()
+        finally:
+          conn.close()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.close()
+      os.unlink(path)
+      self.planner.SaveState()
+    return 0
+
+  @staticmethod
+  def Flush():
+    # The client may have hung up, in which case there's no one to tell.
+    for f in [ sys.stdout, sys.stderr ]:
+      try:
+        f.flush()
+      except IOError:
+        pass
+
+  @staticmethod
+  def GetSocketPath(out_root):
+    # The daemon runs whatever a client sends it, so its socket lives in a
+    # directory that no other user can reach. Unix socket paths are short,
+    # so the output tree is named by its hash.
+    dirname = os.path.join(tempfile.gettempdir(), 'ib-%d' % os.getuid())
+    try:
+      os.mkdir(dirname, 0700)
+    except OSError, err:
+      if err.errno != errno.EEXIST:
+        raise
+    info = os.lstat(dirname)
+    if (not os.path.isdir(dirname) or os.path.islink(dirname) or
+        info.st_uid != os.getuid() or info.st_mode & 0077):
+      raise IbError(
+          "%r must be a directory that only you can use; remove it and try "
+          "again." % dirname)
+    return os.path.join(dirname, hashlib.sha1(out_root).hexdigest()[:16])
+
+
+# -----------------------------------------------------------------------------
+
+
+def AnalyzeIncludes(planner, specs, count=20):
+  "Prints how many translation units include each header and roughly what a change to it costs to rebuild, and the heaviest headers of each unit."
+  planner.PrefetchHdrs(specs)
+  srcs = sorted(set(
+      plan.output_spec for spec in specs
+      for plan in planner.GetClosure(planner.GetPlan(spec))
+      if isinstance(plan, SrcPlan) and isinstance(plan.output_spec, CppSpec)),
+      key=lambda src: src.relpath)
+  # A unit that was never compiled by the native backend is assumed to take
+  # as long as the average one that was.
+  times = dict((src, planner.state.Get('recipe_times', os.path.join(
+      planner.out_root, GetDefaultRelatedSpec(src, ObjSpec).relpath)))
+      for src in srcs)
+  known_times = [ elapsed for elapsed in times.itervalues() if elapsed is not None ]
+  mean_time = sum(known_times) / len(known_times) if known_times else 0.0
+  hdrs_by_src = {}
+  srcs_by_hdr = {}
+  sizes = {}
+  for src in srcs:
+    abspath = planner.GetPlan(src).GetOutputAbspath(planner)
+    planner.GetHdrs(abspath)
+    # The header list leaves out headers from outside the tree, such as
+    # those of third-party libraries, so the raw dependencies are used. The
+    # first is the source itself.
+    entry = planner.state.Get('hdrs', abspath)
+    hdrs_by_src[src] = []
+    for dep, _ in entry[1][1:] if entry is not None else []:
+      relpath = planner.TryConvAbspathToRelpath(dep)
+      if relpath is None and not os.path.isabs(dep):
+        # A missing header, named as it was included.
+        continue
+      hdr = relpath or dep
+      hdrs_by_src[src].append(hdr)
+      srcs_by_hdr.setdefault(hdr, []).append(src)
+      if hdr not in sizes:
+        sizes[hdr] = os.path.getsize(dep) if os.path.exists(dep) else 0
+  costs = dict(
+      (hdr, sum(mean_time if times[src] is None else times[src]
+                for src in hdr_srcs))
+      for hdr, hdr_srcs in srcs_by_hdr.iteritems())
+  print '%d translation units, %d with recorded compile times (the rest are estimated at %.2fs)' % (
+      len(srcs), len(known_times), mean_time)
+  print '  rebuild  fan-out  header'
+  for hdr in sorted(costs, key=lambda hdr: (
+      -costs[hdr], -len(srcs_by_hdr[hdr]), hdr))[:count]:
+    print '%8.2fs  %7d  %s' % (costs[hdr], len(srcs_by_hdr[hdr]), hdr)
+  print 'heaviest headers of the translation units that include the most:'
+  totals = dict(
+      (src, sum(sizes[hdr] for hdr in hdrs)) for src, hdrs in hdrs_by_src.iteritems())
+  for src in sorted(srcs, key=lambda src: (-totals[src], src.relpath))[:count]:
+    print '  %s (%d headers, %.1f KB)' % (
+        src.relpath, len(hdrs_by_src[src]), totals[src] / 1024.0)
+    for hdr in sorted(hdrs_by_src[src], key=lambda hdr: -sizes[hdr])[:5]:
+      print '    %7.1f KB  %s' % (sizes[hdr] / 1024.0, hdr)
+
+
+def Build(planner, specs, args):
+  "Builds the given specs, returning True iff the build succeeded."
+  while True:
+    planner.made_specs = set()
+    with planner.profiler.Span('prefetch headers', 'plan'):
+      planner.PrefetchHdrs(specs)
+    replan = False
+    # Provisional header lists are settled by the compiles, so build in waves
+    # until then rather than link against a plan that may be about to change.
+    # Unity builds batch compiles, and archives and shared libraries batch
+    # objects, across everything that links them, so they need the whole
+    # graph at once.
+    unity = hasattr(planner.cfg, 'unity')
+    archive = hasattr(planner.cfg, 'archive')
+    shared_tests = hasattr(planner.cfg, 'shared_tests')
+    batched = unity or archive or shared_tests
+    provisional = bool(planner.provisional_hdrs)
+    waves = (
+        planner.YieldGraph(specs)
+        if (args.whole_graph or args.backend != 'make' or batched) and
+            not provisional else
+        planner.YieldWaves(specs))
+    if unity and not provisional:
+      waves = [ planner.UnifyJobs(jobs) for jobs in waves ]
+    if shared_tests and not provisional:
+      waves = [ planner.ShareTestJobs(jobs) for jobs in waves ]
+    if archive and not provisional:
+      waves = [ planner.ArchiveJobs(jobs) for jobs in waves ]
+    waves = planner.profiler.TimeYields('plan wave', 'plan', waves)
+    for wave_number, wave in enumerate(waves, start=1):
+      since = time.time()
+      try:
+        with planner.profiler.Span('wave %d' % wave_number, 'wave'):
+          success = RunWave(planner, wave, wave_number, args)
+      finally:
+        if not args.no_run:
+          replan = planner.IngestDepfiles(wave, since)
+      if replan:
+        # A recompiled source now includes different headers, so the rest of
+        # the plan may be wrong. Plan again; what was just built is kept.
+        break
+      if success and batched and provisional and not planner.provisional_hdrs:
+        # The header lists just settled, so the rest can be batched.
+        break
+      if not success:
+        return False
+      if args.no_run:
+        return True
+    else:
+      return True
+
+
+def RunWave(planner, wave, wave_number, args):
+  "Runs (or, with --no_run, just prints) one wave with the chosen backend."
+  rules = [ job.GetRule(planner) for job in wave ]
+  if args.backend == 'native':
+    if args.print_script:
+      print '# wave %d\n%s' % (
+          wave_number, '\n'.join(rule.script for rule in rules))
+    return args.no_run or planner.RunRules(
+        rules, force=args.force, keep_going=args.keep_going,
+        show_progress=args.show_progress)
+  if args.backend == 'ninja':
+    text = planner.ConvRulesToNinja(rules)
+    Run = lambda: planner.RunNinja(
+        text, force=args.force, keep_going=args.keep_going)
+  else:
+    text = planner.ConvRulesToScript(rules, args.show_progress)
+    Run = lambda: planner.RunScript(
+        text, force=args.force,
+        jobs=planner.jobs if args.whole_graph else None,
+        keep_going=args.keep_going)
+  if args.print_script:
+    print '# wave %d\n%s' % (wave_number, text)
+  if args.no_run:
+    return True
+  if not args.force:
+    planner.CheckSignatures(rules)
+  try:
+    return Run()
+  finally:
+    planner.RecordSignatures(rules)
+
+
+def GetCaches(args):
+  "Returns the local and remote caches asked for by the args, either of which may be None."
+  cache = (
+      ObjCache(MakeAbspath(os.getcwd(), args.cache_dir), args.cache_max_mb << 20)
+      if args.cache_dir else None)
+  remote_cache = (
+      None if not args.remote_cache else
+      HttpCache(args.remote_cache)
+      if re.match(r'^https?://', args.remote_cache) else
+      ObjCache(MakeAbspath(os.getcwd(), args.remote_cache), None))
+  return cache, remote_cache
+
+
+def LoadCfg(args):
+  "Loads the args' cfg, reusing the code compiled from its files by earlier runs."
+  return Cfg(
+      args.cfg_root, args.cfg,
+      cache_path=os.path.join(args.out_root, Cfg.CACHE_FILENAME))
+
+
+def MakeAbspath(root, argpath):
+  return (
+      argpath if os.path.isabs(argpath) else
+      os.path.abspath(os.path.join(root, argpath)))
+
+
+def MakePlanner(args, slots=None, shared_scans=None):
+  cache, remote_cache = GetCaches(args)
+  profiler = Profiler()
+  with profiler.Span('load cfg', 'cfg'):
+    cfg = LoadCfg(args)
+  return Planner(
+      cfg=cfg,
+      src_root=args.src_root,
+      out_root=args.out_root,
+      cwd=os.getcwd(),
+      jobs=args.jobs,
+      emit_depfiles=args.depfiles or args.backend == 'ninja',
+      cache=cache,
+      remote_cache=remote_cache,
+      profiler=profiler,
+      slots=slots,
+      shared_scans=shared_scans)
+
+
+def ParseShard(text):
+  "Parses the I/N of --shard."
+  match = re.match(r'^(\d+)/(\d+)$', text)
+  if not match or int(match.group(1)) >= int(match.group(2)):
+    raise argparse.ArgumentTypeError(
+        "%r is not a shard such as 0/4 (the first of four)." % text)
+  return int(match.group(1)), int(match.group(2))
+
+
+def ReportError(err):
+  "Prints an IbError or a CalledProcessError for the user."
+  if isinstance(err, IbError):
+    print '** ib error **'
+    for line in textwrap.wrap(str(err)):
+      print '  ' + line
+  else:
+    print ('*** error running subprocess ***\n%s\n%s\nreturn code: %d' %
+        (err.cmd, err.output, err.returncode))
+
+
+def RunOnDaemon(args):
+  "Has the daemon serving the args' output tree build them, returning the exit status, or None if no daemon is serving it."
+  if not hasattr(socket, 'AF_UNIX'):
+    return None
+  path = Daemon.GetSocketPath(args.out_root)
+  try:
+    if os.stat(path).st_uid != os.getuid():
+      raise IbError("%r belongs to another user; not connecting." % path)
+  except OSError:
+    return None
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(path)
+  except socket.error:
+    return None
+  try:
+    client.sendall(cPickle.dumps(
+        (os.getcwd(), dict(os.environ), args), cPickle.HIGHEST_PROTOCOL))
+    client.shutdown(socket.SHUT_WR)
+    status = None
+    while True:
+      data = client.recv(1 << 16)
+      if not data:
+        break
+      if status is None:
+        output, nul, data = data.partition('\0')
+        sys.stdout.write(output)
+        sys.stdout.flush()
+        if not nul:
+          continue
+        status = ''
+      status += data
+  except KeyboardInterrupt:
+    # Hanging up is enough; the daemon stops streaming and carries on.
+    return -1
+  finally:
+    client.close()
+  if not status:
+    raise IbError("The daemon hung up before the build finished.")
+  return int(status)
+
+
+def RunConfigs(args):
+  "Builds and, if asked, tests the args' targets in each of the configs named by --cfg at once, returning the exit status."
+  # With the native backend, the configs' recipes share --jobs; make and
+  # ninja schedule their own.
+  cfgs = [ cfg for cfg in args.cfg.split(',') if cfg ]
+  slots = threading.BoundedSemaphore(args.jobs or multiprocessing.cpu_count())
+  shared_scans = SharedScans()
+  statuses = {}
+  def Run(cfg):
+    LabeledStream.SetLabel(cfg)
+    cfg_args = argparse.Namespace(**vars(args))
+    cfg_args.cfg = cfg
+    cfg_args.out_root = MakeAbspath(args.src_root, os.path.join(args.out_root, cfg))
+    if args.profile:
+      root, ext = os.path.splitext(args.profile)
+      cfg_args.profile = '%s.%s%s' % (root, cfg, ext)
+    try:
+      statuses[cfg] = RunTargets(
+          MakePlanner(cfg_args, slots=slots, shared_scans=shared_scans), cfg_args)
+    except (IbError, subprocess.CalledProcessError), err:
+      ReportError(err)
+      statuses[cfg] = -1
+    finally:
+      for stream in [ sys.stdout, sys.stderr ]:
+        if isinstance(stream, LabeledStream):
+          stream.EndLine()
+  threads = [ threading.Thread(target=Run, args=(cfg,)) for cfg in cfgs ]
+  old_streams = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = LabeledStream(sys.stdout), LabeledStream(sys.stderr)
+  try:
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      while thread.is_alive():
+        thread.join(1)
+  finally:
+    sys.stdout, sys.stderr = old_streams
+  for cfg in cfgs:
+    print '%s%s %s%s' % (
+        GREEN if statuses.get(cfg) == 0 else RED,
+        'succeeded' if statuses.get(cfg) == 0 else 'failed', cfg, NORMAL)
+  return 0 if all(statuses.get(cfg) == 0 for cfg in cfgs) else -1
+
+
+def RunTargets(planner, args):
+  "Builds and, if asked, tests the args' targets, returning the exit status."
+  if args.print_args:
+    for key in [ 'src_root', 'out_root', 'cfg_root', 'cfg' ]:
+      print '%s = %r' % (key, getattr(args, key))
+  if args.print_cfg:
+    print planner.cfg
+  try:
+    if args.test_all:
+      specs = sorted(set(
+          spec for target in args.targets
+          for spec in planner.FindTests(planner.ConvTargetToRelpath(target))),
+          key=lambda spec: spec.relpath)
+    else:
+      specs = [ planner.ConvTargetToSpec(target) for target in args.targets ]
+    if args.shard is not None and (args.test_all or args.test):
+      index, count = args.shard
+      test_specs = sorted(
+          set(spec for spec in specs if spec.atom.endswith('-test')),
+          key=lambda spec: spec.relpath)
+      shard_specs = set(test_specs[index::count])
+      specs = [
+          spec for spec in specs
+          if not spec.atom.endswith('-test') or spec in shard_specs ]
+    if args.analyze_includes:
+      AnalyzeIncludes(planner, specs)
+      return 0
+    success = Build(planner, specs, args)
+    if args.no_run:
+      return 0
+    if success and (args.test_all or args.test):
+      with planner.profiler.Span('run tests', 'test'):
+        success = TestRunner(
+            planner, [ spec for spec in specs if spec.atom.endswith('-test') ],
+            jobs=args.test_jobs, timeout=args.test_timeout,
+            skip_unchanged=args.test_changed).Run()
+    return 0 if success else -1
+  finally:
+    planner.SaveState()
+    if args.profile:
+      planner.profiler.Write(MakeAbspath(os.getcwd(), args.profile))
+      for line in planner.profiler.Summarize():
+        print line
+    if planner.cache is not None and not args.no_run:
+      total_hits, total_misses = planner.cache.SaveStats()
+      size, count = planner.cache.Trim()
+      if args.cache_stats:
+        print 'cache: %d hits, %d misses (%d hits, %d misses in all; %.1f MB in %d files)' % (
+            planner.cache.hits, planner.cache.misses, total_hits, total_misses,
+            size / float(1 << 20), count)
+    if planner.remote_cache is not None and args.cache_stats:
+      print 'remote cache: %d hits, %d misses' % (
+          planner.remote_cache.hits, planner.remote_cache.misses)
+
+
 LABEL_FILE = '__ib__'
 
 RED = '\x1b[1;31m'
@@ -801,7 +3140,16 @@ def main():
              "the root of the source tree. The default is %r." % cfg_root)
     parser.add_argument(
         '--cfg', default=cfg,
-        help="The configuration to build. The default is %r." % cfg)
+        help="The configuration to build, or several separated by commas "
+             "(e.g., debug,release,asan) to build at once, each in its own "
+             "subdirectory of the output tree. Configs whose compiler args "
+             "differ only in debug info (-g) and warning (-W, -w) flags "
+             "share their header scans. The default is %r." % cfg)
+    parser.add_argument(
+        '--jobs', type=int,
+        help="The number of header scans to run at once while planning, and "
+             "of make jobs to run at once with --whole_graph. The default is "
+             "the number of CPUs.")
     parser.add_argument(
         '--print_args', action='store_true',
         help="Print the arguments to the build, including the root "
@@ -820,17 +3168,124 @@ def main():
         help="Don't actually run any make scripts. Use this option when you "
              "want to see what the build waves would contain but not actually "
              "run them.")
+    parser.add_argument(
+        '--whole_graph', action='store_true',
+        help="Build the whole job graph with a single parallel make script "
+             "instead of one script per wave, so each link starts as soon as "
+             "its own objects are done.")
+    parser.add_argument(
+        '--backend', choices=[ 'make', 'ninja', 'native' ], default='make',
+        help="What runs the build. 'make' writes a makefile per wave and runs "
+             "the configured make tool on it. 'ninja' writes the whole job "
+             "graph to %s in the output tree, with compiler depfiles, and "
+             "runs ninja on it. 'native' runs the whole job graph's recipes "
+             "itself, --jobs at a time, without make. The default is "
+             "'make'." % Planner.NINJA_FILENAME)
+    parser.add_argument(
+        '--depfiles', action='store_true',
+        help="Have each compile also write a depfile and use it to update the "
+             "header cache, so a source that was compiled before isn't "
+             "scanned separately when it changes. Always on with the ninja "
+             "backend.")
+    parser.add_argument(
+        '--cache_dir',
+        help="A directory in which to cache compiled objects, keyed on their "
+             "exact commands, the contents of their sources and headers, and "
+             "the compiler, so any output tree can restore them instead of "
+             "compiling. Keys ignore where the source and output trees are, "
+             "so code that bakes IB_SRC_ROOT or IB_OUT_ROOT into objects "
+             "shouldn't use it; system headers aren't part of the key. Only "
+             "the native backend uses the cache.")
+    parser.add_argument(
+        '--cache_max_mb', type=int, default=5000,
+        help="Trim the --cache_dir to this many megabytes, dropping the least "
+             "recently used objects first. The default is %(default)d.")
+    parser.add_argument(
+        '--cache_stats', action='store_true',
+        help="Print the caches' hits and misses after building.")
+    parser.add_argument(
+        '--remote_cache',
+        help="A cache shared between machines, consulted after --cache_dir "
+             "and filled with whatever is built: either the http:// URL of a "
+             "server started with --serve_cache, or a shared directory. It "
+             "holds linked executables as well as objects. Only the native "
+             "backend uses it.")
+    parser.add_argument(
+        '--serve_cache', metavar='DIR',
+        help="Instead of building, serve DIR as a --remote_cache over HTTP "
+             "until interrupted. DIR is trimmed to --cache_max_mb as it "
+             "grows.")
+    parser.add_argument(
+        '--serve_address', default='localhost:8700',
+        help="The host:port that --serve_cache listens on. The default is "
+             "%(default)r.")
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help="Instead of building, stay running and do the builds of later ib "
+             "runs with the same roots and cfg, which hand them over a unix "
+             "socket and print their output. The daemon keeps its plans and "
+             "header lists in memory between builds and, where inotify is "
+             "available, forgets only what changed files affect, so builds "
+             "start at once. Don't build its output tree with --no_daemon "
+             "while it runs.")
+    parser.add_argument(
+        '--no_daemon', action='store_true',
+        help="Build in this process even if a --daemon is serving the "
+             "output tree.")
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help="Write a Chrome trace of the run to FILE, for chrome://tracing "
+             "or Perfetto, and print where the time went: in loading the "
+             "cfg, planning, header scans, each wave and tests, along with "
+             "the critical path and slowest compiles. Only the native "
+             "backend times individual recipes.")
+    parser.add_argument(
+        '--analyze_includes', action='store_true',
+        help="Instead of building, scan the targets' headers and print, for "
+             "the headers with the costliest changes, how many translation "
+             "units include each and how long they took to compile (as "
+             "last recorded by the native backend), followed by the largest "
+             "headers of the units that include the most. Headers from "
+             "outside the tree are shown by absolute path.")
+    parser.add_argument(
+        '--keep_going', action='store_true',
+        help="Keep building whatever doesn't depend on a failed job instead "
+             "of stopping at the first failure.")
     parser.add_argument(
         '--force', action='store_true',
         help="Force a total rebuild by considering all targets to be out of "
-             "date. Make sure to specify this option after you modify the "
-             "contents of a relevant config file.")
+             "date. This shouldn't be needed after you modify a config file, "
+             "as each output is rebuilt when its exact command or the "
+             "contents of its inputs change.")
     parser.add_argument(
         '--test', action='store_true',
         help="Run each unit test after building.")
     parser.add_argument(
         '--test_all', action='store_true',
-        help="Compile and run all the tests in the given subtree.")
+        help="Compile and run all the tests in the given subtrees, which are "
+             "given like targets. Dot directories, the output tree and "
+             "directories matching any of the cfg's test_all.ignore patterns "
+             "(such as 'third_party/*') aren't searched.")
+    parser.add_argument(
+        '--test_jobs', type=int,
+        help="The number of tests to run at once. Each test's output is "
+             "printed only if it fails. The default is --jobs.")
+    parser.add_argument(
+        '--test_timeout', type=float,
+        help="Kill any test that runs longer than this many seconds and count "
+             "it as failed. By default, tests may run as long as they like.")
+    parser.add_argument(
+        '--test_changed', action='store_true',
+        help="Skip any test that passed the last time it ran, if neither its "
+             "executable nor any source or header it was built from has "
+             "changed since. Tests that read other files may be skipped "
+             "wrongly.")
+    parser.add_argument(
+        '--shard', type=ParseShard, metavar='I/N',
+        help="Build and run only the I-th of N equal shares of the tests, "
+             "counting from 0, so N machines can split a test run. The "
+             "shares are dealt out from the tests sorted by spec, so every "
+             "machine must be given the same targets.")
     parser.add_argument(
         'targets', metavar='target', nargs='*',
         help="The spec of a target you want to build. If relative, the spec "
@@ -840,12 +3295,19 @@ def main():
              "or the output tree, then you must give only absolute specs. The "
              "target will be built in the output tree.")
     return parser.parse_args()
-  def MakeAbspath(root, argpath):
-    return (
-        argpath if os.path.isabs(argpath) else
-        os.path.abspath(os.path.join(root, argpath)))
   try:
     args = GetArgs()
+    if args.serve_cache:
+      host, port = args.serve_address.rsplit(':', 1)
+      cache = ObjCache(
+          MakeAbspath(os.getcwd(), args.serve_cache), args.cache_max_mb << 20)
+      server = CacheServer((host, int(port)), cache)
+      print 'serving %s on http://%s' % (cache.root, args.serve_address)
+      try:
+        server.serve_forever()
+      except KeyboardInterrupt:
+        pass
+      return 0
     if not args.src_root:
       raise IbError(
           "The root of the source tree was not given and could not be found. "
@@ -862,62 +3324,20 @@ def main():
       raise IbError(
           "You are trying to use %r as the root of the config tree; however, "
           "it either doesn't exist or is not a directory." % args.cfg_root)
+    if ',' in args.cfg:
+      return RunConfigs(args)
     args.out_root = MakeAbspath(
         args.src_root, os.path.join(args.out_root, args.cfg))
-    if args.print_args:
-      for key in [ 'src_root', 'out_root', 'cfg_root', 'cfg' ]:
-        print '%s = %r' % (key, getattr(args, key))
-    cfg = Cfg(args.cfg_root, args.cfg)
-    if args.print_cfg:
-      print cfg
-    planner = Planner(
-        cfg=cfg,
-        src_root=args.src_root,
-        out_root=args.out_root)
-    targets = []
-    if args.test_all:
-      for target in args.targets:
-        for root, _, filenames in os.walk(target):
-          for filename in filenames:
-            if filename.endswith('-test.cc'):
-              targets.append(os.path.join(root, filename[:len(filename) - 3]))
-    else:
-      targets = args.targets
-    success = True
-    specs = [ planner.ConvTargetToSpec(target) for target in targets ]
-    for wave_number, wave in enumerate(planner.YieldWaves(specs), start=1):
-      script = planner.ConvWaveToScript(wave, args.show_progress)
-      if args.print_script:
-        print '# wave %d\n%s' % (wave_number, script)
-      if args.no_run:
-        return 0
-      if not planner.RunScript(script, force=args.force):
-        success = False
-        break
-    if success and (args.test_all or args.test):
-      pass_specs = []
-      fail_specs = []
-      for spec in [ spec for spec in specs if spec.atom.endswith('-test') ]:
-        print 'running %s' % spec.relpath
-        status = subprocess.call(
-            [ os.path.join(planner.out_root, spec.relpath) ])
-        (pass_specs if status == 0 else fail_specs).append(spec)
-      for name, specs in [
-          (GREEN + 'passed' + NORMAL, pass_specs),
-          (RED + 'failed' + NORMAL, fail_specs) ]:
-        if specs:
-          print '%s %d (%s)' % (
-              name, len(specs), ', '.join(spec.relpath for spec in specs))
-      success = not fail_specs
-    return 0 if success else -1
-  except IbError, err:
-    print '** ib error **'
-    for line in textwrap.wrap(str(err)):
-      print '  ' + line
+    if args.daemon:
+      return Daemon(args).Serve()
+    if not args.no_daemon:
+      status = RunOnDaemon(args)
+      if status is not None:
+        return status
+    return RunTargets(MakePlanner(args), args)
+  except (IbError, subprocess.CalledProcessError), err:
+    ReportError(err)
     return -1
-  except subprocess.CalledProcessError, err:
-    print ('*** error running subprocess ***\n%s\n%s\nreturn code: %d' %
-        (err.cmd, err.output, err.returncode))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+# Copyright Jason Lucas
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import argparse, json, os, random, shutil, stat, subprocess, sys, tempfile, time
+
+import ib
+
+
+# -----------------------------------------------------------------------------
+
+
+STUB_COMPILER = r'''
+"A stand-in for the compiler and linker that does no real work, so that timings are ib's alone."
+
+import hashlib, os, re, sys
+
+INCLUDE_PATTERN = re.compile(r'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+
+def FindHdrs(abspath, incl_dirs, hdrs):
+  with open(abspath) as f:
+    text = f.read()
+  for name in INCLUDE_PATTERN.findall(text):
+    for incl_dir in [ os.path.dirname(abspath) ] + incl_dirs:
+      path = os.path.join(incl_dir, name)
+      if os.path.isfile(path):
+        break
+    else:
+      path = name
+    if path not in hdrs:
+      hdrs.append(path)
+      if os.path.isfile(path):
+        FindHdrs(path, incl_dirs, hdrs)
+  return hdrs
+
+
+def GetDigest(paths):
+  digest = hashlib.sha1()
+  for path in paths:
+    with open(path, 'rb') as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def main():
+  args = sys.argv[1:]
+  incl_dirs = [ arg[2:] for arg in args if arg.startswith('-I') and len(arg) > 2 ]
+  out = args[args.index('-o') + 1] if '-o' in args else None
+  depfile = args[args.index('-MF') + 1] if '-MF' in args else None
+  inputs = [
+      arg for arg in args
+      if not arg.startswith('-') and arg not in (out, depfile) and
+          os.path.isfile(arg) ]
+  if '-MM' in args:
+    src = inputs[0]
+    sys.stdout.write('%s.o: %s\n' % (
+        os.path.splitext(os.path.basename(src))[0],
+        ' '.join([ src ] + FindHdrs(src, incl_dirs, []))))
+    return 0
+  if '-c' in args:
+    hdrs = FindHdrs(inputs[0], incl_dirs, [])
+    if depfile:
+      with open(depfile, 'w') as f:
+        f.write('%s: %s\n' % (out, ' '.join(inputs + hdrs)))
+    inputs += [ hdr for hdr in hdrs if os.path.isfile(hdr) ]
+  with open(out, 'w') as f:
+    f.write(GetDigest(inputs) + '\n')
+  return 0
+
+
+if __name__ == '__main__':
+  exit(main())
+'''
+
+CFG = '''cc = Obj(
+  tool=%(tool)r,
+  flags=[],
+  hdrs_flags=[ '-MM', '-MG' ],
+  incl_dirs=[]
+)
+
+link = Obj(
+  tool=%(tool)r,
+  flags=[],
+  libs=[],
+  static_libs=[],
+  lib_dirs=[]
+)
+
+make = Obj(
+  tool='make',
+  flags=[ '-s' ],
+  force_flag='-B',
+  all_pseudo_target='all'
+)
+'''
+
+CFG_NAME = 'bench'
+DIR_SIZE = 50
+
+
+def GenerateTree(root, sources, depth, fan_out, tests, seed):
+  "Writes a synthetic project to root, returning the relpaths of its sources and of its tests."
+  # The sources are dealt into depth layers. Each header includes fan_out
+  # headers of the next layer down, and each test fan_out of the top one, so
+  # the include graph is depth deep.
+  rand = random.Random(seed)
+  layers = [ [] for _ in range(depth) ]
+  for index in range(sources):
+    layer = index * depth // sources
+    layers[layer].append('l%d/d%d/m%d' % (layer, len(layers[layer]) // DIR_SIZE, index))
+  def Write(relpath, text):
+    abspath = os.path.join(root, relpath)
+    if not os.path.isdir(os.path.dirname(abspath)):
+      os.makedirs(os.path.dirname(abspath))
+    with open(abspath, 'w') as f:
+      f.write(text)
+  def Includes(layer):
+    if layer >= depth:
+      return ''
+    names = rand.sample(layers[layer], min(fan_out, len(layers[layer])))
+    return ''.join('#include "%s.h"\n' % name for name in sorted(names))
+  src_relpaths = []
+  for layer, names in enumerate(layers):
+    for name in names:
+      atom = os.path.basename(name)
+      Write(name + '.h', '#pragma once\n%sint %s();\n' % (Includes(layer + 1), atom))
+      Write(name + '.cc', '#include "%s.h"\n\nint %s() { return 0; }\n' % (name, atom))
+      src_relpaths.append(name + '.cc')
+  test_relpaths = []
+  for index in range(tests):
+    relpath = 't/d%d/x%d-test.cc' % (index // DIR_SIZE, index)
+    Write(relpath, '%s\nint main() { return 0; }\n' % Includes(0))
+    test_relpaths.append(relpath)
+  stub_path = os.path.join(root, 'stubcc')
+  Write('stubcc', '#!%s\n%s' % (sys.executable, STUB_COMPILER))
+  os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IXUSR)
+  Write(ib.LABEL_FILE, '')
+  Write(CFG_NAME + '.cfg', CFG % { 'tool': stub_path })
+  return src_relpaths, test_relpaths
+
+
+# -----------------------------------------------------------------------------
+
+
+def MakePlanner(root, jobs):
+  return ib.Planner(
+      cfg=ib.Cfg(root, CFG_NAME),
+      src_root=root,
+      out_root=os.path.join(root, 'out', CFG_NAME),
+      cwd=root,
+      jobs=jobs)
+
+
+def Time(repeat, Setup, Run):
+  "Returns the seconds Run took on each of repeat tries, calling Setup untimed before each."
+  times = []
+  for _ in range(repeat):
+    Setup()
+    start = time.time()
+    Run()
+    times.append(time.time() - start)
+  return times
+
+
+def RunBenchmarks(root, src_relpaths, test_relpaths, repeat, jobs):
+  "Times each phase of planning and building the tree, returning (name, times) pairs in order."
+  results = []
+  planner = MakePlanner(root, jobs)
+  src_abspaths = [ os.path.join(root, relpath) for relpath in src_relpaths ]
+  test_specs = [
+      planner.ConvRelpathToSpec(ib.ReplaceExt(relpath, ''))
+      for relpath in test_relpaths ]
+  obj_specs = [
+      planner.ConvRelpathToSpec(ib.ReplaceExt(relpath, '.o'))
+      for relpath in src_relpaths + test_relpaths ]
+
+  # Scanning runs the stub once per source, so it's timed once.
+  results.append(('scan headers (cold)', Time(
+      1, lambda: None, lambda: planner.PrefetchHdrs(test_specs))))
+  planner.SaveState()
+
+  holder = {}
+  def NewPlanner():
+    holder['planner'] = MakePlanner(root, jobs)
+  def GetAllHdrs():
+    for abspath in src_abspaths:
+      holder['planner'].GetHdrs(abspath)
+  results.append(('GetHdrs (from state)', Time(repeat, NewPlanner, GetAllHdrs)))
+
+  def ClearPlans():
+    planner.cached_plans = {}
+  def GetAllPlans():
+    for spec in obj_specs + test_specs:
+      planner.GetPlan(spec)
+  results.append(('GetPlan', Time(repeat, ClearPlans, GetAllPlans)))
+
+  def ClearMade():
+    planner.made_specs = set()
+  def YieldAllWaves():
+    holder['waves'] = list(planner.YieldWaves(test_specs))
+  results.append(('YieldWaves', Time(repeat, ClearMade, YieldAllWaves)))
+
+  def ConvAllWaves():
+    for wave in holder['waves']:
+      planner.ConvWaveToScript(wave, False)
+  results.append(('ConvWaveToScript', Time(repeat, lambda: None, ConvAllWaves)))
+
+  # The builds run ib itself, as a user would, without a daemon.
+  args = [
+      sys.executable, os.path.join(os.path.dirname(os.path.abspath(ib.__file__)), 'ib'),
+      '--no_daemon', '--backend', 'native', '--cfg', CFG_NAME,
+      '--out_root', os.path.join(root, 'out') ] + [
+      '/' + spec.relpath for spec in test_specs ]
+  def Build():
+    with open(os.devnull, 'w') as devnull:
+      if subprocess.call(args, cwd=root, stdout=devnull) != 0:
+        raise ib.IbError("the build of %s failed" % root)
+  results.append(('build (cold)', Time(1, lambda: None, Build)))
+  results.append(('no-op rebuild', Time(repeat, lambda: None, Build)))
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Times ib's planning and no-op rebuilds on a synthetic "
+                  "project built with a stub compiler, so the numbers are ib's "
+                  "own overhead.")
+  parser.add_argument(
+      '--sources', type=int, default=2000,
+      help="The number of .cc/.h pairs to generate. The default is 2000.")
+  parser.add_argument(
+      '--depth', type=int, default=6,
+      help="The number of layers the headers include down through. The "
+           "default is 6.")
+  parser.add_argument(
+      '--fan_out', type=int, default=4,
+      help="The number of headers each header and test includes. The "
+           "default is 4.")
+  parser.add_argument(
+      '--tests', type=int, default=200,
+      help="The number of -test targets to generate. The default is 200.")
+  parser.add_argument(
+      '--seed', type=int, default=0,
+      help="The seed for choosing includes, so a tree can be generated "
+           "again exactly. The default is 0.")
+  parser.add_argument(
+      '--repeat', type=int, default=5,
+      help="The number of times to time each phase; the best and median are "
+           "reported. The default is 5.")
+  parser.add_argument(
+      '--jobs', type=int,
+      help="The number of jobs ib may run at once. The default is the number "
+           "of CPUs.")
+  parser.add_argument(
+      '--root',
+      help="Where to generate the project. The default is a temporary "
+           "directory, removed afterward.")
+  parser.add_argument(
+      '--json', metavar='FILE',
+      help="Also write the parameters and results to FILE, to compare "
+           "across versions.")
+  args = parser.parse_args()
+  root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix='ib-bench-')
+  try:
+    if os.path.exists(os.path.join(root, 'out')):
+      shutil.rmtree(os.path.join(root, 'out'))
+    src_relpaths, test_relpaths = GenerateTree(
+        root, args.sources, args.depth, args.fan_out, args.tests, args.seed)
+    results = RunBenchmarks(root, src_relpaths, test_relpaths, args.repeat, args.jobs)
+  finally:
+    if not args.root:
+      shutil.rmtree(root)
+  params = dict(
+      (key, getattr(args, key))
+      for key in [ 'sources', 'depth', 'fan_out', 'tests', 'seed', 'repeat' ])
+  print 'ib benchmark: %s' % ', '.join(
+      '%s=%d' % (key, value) for key, value in sorted(params.iteritems()))
+  print '  %-24s %10s %10s' % ('phase', 'best', 'median')
+  for name, times in results:
+    print '  %-24s %9.3fs %9.3fs' % (
+        name, min(times), sorted(times)[len(times) // 2])
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({
+          'params': params,
+          'results': [
+              { 'phase': name, 'times': times } for name, times in results ] },
+          f, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == '__main__':
+  exit(main())